@@ -0,0 +1,77 @@
+##########################################
+#####  Imports
+##########################################
+
+# Installed Imports
+import numpy as np
+
+#Locally authored classes
+from Frame import Frame
+from StackCube import StackCube
+
+class CalibratedFrames:
+    """The CalibratedFrames Class is a calibration stage that hands out
+    (frame - masterDark) / masterFlat for a list of frames, one at a time.
+
+    Iterating over a CalibratedFrames object yields the calibrated data of
+    each frame as np.ndarray. All frames are computed in place in the same
+    preallocated buffer, so a yielded array is only valid until the next one
+    is requested (copy it to keep it). Frames read from disk are released
+    as soon as they are calibrated. It can be iterated more than once, e.g.
+    by combine engines that need two passes.
+
+    rows() calibrates one strip of rows of every frame, so the median can be
+    combined strip by strip within its memory budget (see redux_combine.strips).
+    toStack() instead calibrates every frame straight into a StackCube, for
+    worker processes that need the whole stack in shared memory.
+    """
+
+    def __init__(self, frames, masterDark=None, masterFlat=None, dtype=np.float64):
+        self.frames = frames
+        #Masters may be given as Frames or as np.ndarrays, only their data is kept
+        self.masterDark = masterDark.data if isinstance(masterDark, Frame) else masterDark
+        self.masterFlat = masterFlat.data if isinstance(masterFlat, Frame) else masterFlat
+        self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def shape(self):
+        """(rows, columns) of every frame"""
+        return self.frames[0].shape
+
+    def __iter__(self):
+        dark, flat = self.masterDark, self.masterFlat
+        buffer = np.empty(self.shape, dtype=self.dtype)
+        for f in self.frames:
+            if dark is None:
+                np.copyto(buffer, f.data, casting='unsafe')
+            else:
+                np.subtract(f.data, dark, out=buffer, casting='unsafe')
+            if flat is not None:
+                np.divide(buffer, flat, out=buffer, casting='unsafe')
+            f.release()
+            yield buffer
+
+    def rows(self, start, stop):
+        """Return (frames, stop-start, columns) array of the calibrated rows start:stop of every frame
+        Frames that are not in memory only read these rows from their files
+        """
+        cube = np.empty((len(self), stop - start, self.shape[1]), dtype=self.dtype)
+        for slot, f in zip(cube, self.frames):
+            np.copyto(slot, f.rows(start, stop) if isinstance(f, Frame) else np.asarray(f)[start:stop], casting='unsafe')
+        if self.masterDark is not None:
+            np.subtract(cube, self.masterDark[start:stop], out=cube, casting='unsafe')
+        if self.masterFlat is not None:
+            np.divide(cube, self.masterFlat[start:stop], out=cube, casting='unsafe')
+        return cube
+
+    def toStack(self, directory=None, shared=False):
+        """Return StackCube (see StackCube for directory and shared) of all calibrated frames"""
+        dark, flat = self.masterDark, self.masterFlat
+        stack = StackCube(len(self), self.shape, self.dtype, directory, shared)
+        for f in self.frames:
+            stack.append(f.data, subtract=dark, divide=flat)
+            f.release()
+        return stack
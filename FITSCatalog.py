@@ -0,0 +1,112 @@
+##########################################
+#####  Imports
+##########################################
+
+# Native Imports
+import sqlite3, hashlib
+
+class FITSCatalog:
+    """The FITSCatalog Class is a SQLite table of every FITS file scanned by
+    findFITS. For each file (keyed by its real path) it records:
+    size, mtime - used to tell whether the file changed since it was cataloged
+    frametyp, filter, gain, exptime - the header values used to sort frames
+    naxis1, naxis2 - shape of the image
+    hash - SHA-1 of the file contents, used to find copies of the same frame.
+        It is only computed for files that may be copies of another one (see
+        sameContents), otherwise it is None.
+
+    Files whose size and mtime match their record do not have to be opened
+    again to be sorted.
+    """
+
+    # Header keywords stored in the catalog
+    keywords = ('FRAMETYP', 'FILTER', 'GAIN', 'EXPTIME', 'NAXIS1', 'NAXIS2')
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        #Columns without a declared type keep the Python type they were given (int gain, float exptime)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS files ("
+                                 "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+                                 "frametyp, filter, gain, exptime, naxis1, naxis2, hash TEXT)")
+        self._connection.commit()
+
+    def records(self):
+        """Return dictionary of all records, keyed by path"""
+        self._connection.row_factory = sqlite3.Row
+        rows = self._connection.execute("SELECT * FROM files").fetchall()
+        return {row['path']: dict(row) for row in rows}
+
+    def update(self, records):
+        """Insert or replace records (dictionaries as returned by makeRecord)"""
+        columns = ('path', 'size', 'mtime') + tuple(k.lower() for k in self.keywords) + ('hash',)
+        self._connection.executemany(
+            f"INSERT OR REPLACE INTO files ({', '.join(columns)}) VALUES ({', '.join('?'*len(columns))})",
+            [tuple(record[c] for c in columns) for record in records])
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    @staticmethod
+    def isCurrent(record, stat):
+        """Return True if record still describes a file with os.stat result stat"""
+        return record is not None and (record['size'], record['mtime']) == (stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def makeRecord(path, stat, header):
+        """Return catalog record for the file at path with os.stat result stat and FITS header"""
+        record = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        for keyword in FITSCatalog.keywords:
+            record[keyword.lower()] = header.get(keyword)
+        #Reading the whole file is only worth it for possible copies (see sameContents)
+        record['hash'] = None
+        return record
+
+    @staticmethod
+    def duplicateKey(record):
+        """Return tuple that is the same for copies of a file: its size and header values
+        Only files with the same key have to be compared by their hash
+        """
+        return (record['size'],) + tuple(record[keyword.lower()] for keyword in FITSCatalog.keywords)
+
+    @staticmethod
+    def _sample(record, size=1 << 16):
+        #SHA-1 of the first and last size bytes of the file (header and the end of the pixels),
+        #  kept with the record but not stored in the catalog
+        if '_sample' not in record:
+            sha = hashlib.sha1()
+            with open(record['path'], 'rb') as f:
+                sha.update(f.read(size))
+                f.seek(max(record['size'] - size, 0))
+                sha.update(f.read(size))
+            record['_sample'] = sha.hexdigest()
+        return record['_sample']
+
+    @staticmethod
+    def sameContents(record, other):
+        """Return True if the files of two records with the same duplicateKey have the same contents
+        The files are only read in full (fileHash) if their first and last 64 KiB are the same
+        """
+        if record['hash'] is not None and other['hash'] is not None:
+            return record['hash'] == other['hash']
+        if FITSCatalog._sample(record) != FITSCatalog._sample(other):
+            return False
+        return FITSCatalog.fileHash(record) == FITSCatalog.fileHash(other)
+
+    @staticmethod
+    def fileHash(record):
+        """Return SHA-1 of the contents of the file of record, computed and stored in it on first use"""
+        if record['hash'] is None:
+            sha = hashlib.sha1()
+            with open(record['path'], 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            record['hash'] = sha.hexdigest()
+        return record['hash']
+
+    @staticmethod
+    def header(record):
+        """Return dictionary of the header keywords held by record (missing keywords left out)"""
+        return {keyword: record[keyword.lower()] for keyword in FITSCatalog.keywords
+                if record[keyword.lower()] is not None}
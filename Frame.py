@@ -4,6 +4,44 @@
 
 # Installed Imports
 import numpy as np
+from astropy.io import fits
+
+def _moments(data, mask=None, blockRows=256):
+    #Mean, std, min and max of data (only where mask is True) in a single pass
+    #  Each block of rows is small enough to stay in cache, and the block means and
+    #  sums of squared deviations are merged (Chan et al.) so std stays accurate
+    n, mean, M2 = 0, 0.0, 0.0
+    low, high = None, None
+    for start in range(0, data.shape[0], blockRows):
+        block = data[start:start+blockRows]
+        if mask is not None:
+            block = block[mask[start:start+blockRows]]
+        if block.size == 0:
+            continue
+
+        values = block.astype(np.float64)
+        blockN = values.size
+        blockMean = values.mean()
+        blockM2 = np.square(values - blockMean).sum()
+
+        delta = blockMean - mean
+        total = n + blockN
+        mean += delta * blockN / total
+        M2 += blockM2 + delta**2 * n * blockN / total
+        n = total
+
+        low = block.min() if low is None else min(low, block.min())
+        high = block.max() if high is None else max(high, block.max())
+    return mean, np.sqrt(M2 / n), low, high
+
+def imageHDU(hdul):
+    """Return the HDU of hdul that holds the image: the primary HDU, or extension 1
+    of fpack-compressed (.fits.fz) files whose primary HDU is empty
+    """
+    for hdu in hdul:
+        if hdu.is_image and hdu.header.get('NAXIS', 0) > 0:
+            return hdu
+    return hdul[0]
 
 class Frame:
     """The Frame Class defines a few class variables that are extracted
@@ -13,52 +51,174 @@ class Frame:
     filter - Upper-case string restrictded to single-letter Johnson Filter Set
     gain - integer gain level reported by SharpCap
     intTime - float exposure time used to collect frame
+    path - file the frame was read from (None for master frames)
 
-    Further, the header portion of the associated FITS HDU is stored for 
-    later access/modification.
+    Further, the header values the pipeline uses (see keywords) are kept
+    in a compact record. The full header of the associated FITS HDU is only
+    stored for frames without a file (masters); a Frame read from path
+    reads its full header again on first access.
 
-    Finally, some statistics are calculated and stored along with each 
-    Frame object.
+    Finally, some statistics (std, mean, median, max, min) are calculated
+    the first time they are used and stored along with each Frame object.
 
     Importantly, calling an instance of a Frame object returns the data 
     portion of the assocated FITS HDU.
+
+    A Frame may be created with data=None and a path (header-only scan).
+    The pixel data is then read (memory-mapped) from path the first time
+    data is accessed and can be dropped again with release(). path may be
+    a fpack-compressed (.fits.fz) file; rows() and section() then only
+    decompress the tiles they need.
+
+    Frames use __slots__ and pickle without the pixels of deferred frames
+    or the full header of frames read from a file, so thousands of them are
+    cheap to hold and to send to worker processes.
+
+    frame -= other and frame /= other (Frames, arrays or numbers) work in
+    place on the data and return the same Frame.
     """
 
-    def __init__(self, data, type, filter, gain, intTime, header, badMap=None):
-        self.data = data
+    __slots__ = ('_data', '_deferred', 'type', 'filter', 'gain', 'intTime', '_record', '_header', \
+                 'path', 'subFrameList', 'badMap', '_stats', 'darkCorr', 'flatCorr')
+
+    # Header keywords kept in the compact record of every Frame
+    keywords = ('FRAMETYP', 'FILTER', 'GAIN', 'EXPTIME', 'NAXIS1', 'NAXIS2')
+
+    # Defaults for computeStats, set from the program arguments
+    singlePass = True
+    excludeBad = False
+    # Floating point type raw data is converted to by in-place arithmetic, set from --precision
+    precision = np.dtype(np.float32)
+
+    def __init__(self, data, type, filter, gain, intTime, header, badMap=None, path=None):
+        self._data = data
+        #Frames without data are handles on a file, load pixels on first access
+        self._deferred = data is None and path is not None
         self.type = type
         self.filter = filter
         self.gain = gain
         self.intTime = intTime
-        self.header = header
+        #header may be a FITS header or a dictionary of keywords (catalog record)
+        self._record = tuple(None if header is None else header.get(k) for k in Frame.keywords)
+        #Frames read from a file get their full header from it again when asked for
+        self._header = header if path is None else None
+        self.path = path
         #TODO: Add x,y dimensions as private parameter to check in append of FrameList
 
         if self.type == 'master':
             self.subFrameList = None
-        # TODO: Repalce this histFilter with a bad-pixel filter
-
-#         histFilter = np.where((self.data<65535) & (self.data>0))
-#         print(np.where((self.data<65535) & (self.data>0)))
-# 
-#         self.std = np.std(self.data[histFilter])
-#         self.mean = np.mean(self.data[histFilter])
-#         self.median = np.median(self.data[histFilter])
-#         self.max = np.max(self.data[histFilter])
-#         self.min = np.min(self.data[histFilter])
         self.badMap = badMap
-#        self.std = np.std(self.data[histFilter])
-#        self.mean = np.mean(self.data[histFilter])
-#        self.median = np.median(self.data[histFilter])
-#        self.max = np.max(self.data[histFilter])
-#        self.min = np.min(self.data[histFilter])
-        self.std = np.std(self.data)
-        self.mean = np.mean(self.data)
-        self.median = np.median(self.data)
-        self.max = np.max(self.data)
-        self.min = np.min(self.data)
+        #Statistics are computed the first time one of them is asked for
+        self._stats = None
         self.darkCorr = False
         self.flatCorr = False
 
+    def computeStats(self, singlePass=None, excludeBad=None):
+        """Compute (and cache) std, mean, median, max and min of the data
+        singlePass - mean, std, min and max are accumulated in one pass over
+            blocks of rows instead of one full pass per statistic
+        excludeBad - only use pixels marked good (True) in badMap
+        Both default to the Frame.singlePass and Frame.excludeBad class settings.
+        """
+        singlePass = Frame.singlePass if singlePass is None else singlePass
+        excludeBad = Frame.excludeBad if excludeBad is None else excludeBad
+
+        data = self.data
+        mask = self.badMap if excludeBad and self.badMap is not None else None
+
+        if singlePass:
+            mean, std, low, high = _moments(data, mask)
+        else:
+            values = data if mask is None else data[mask]
+            mean, std, low, high = np.mean(values), np.std(values), np.min(values), np.max(values)
+        median = np.median(data if mask is None else data[mask])
+
+        self._stats = dict(std=std, mean=mean, median=median, max=high, min=low)
+        return self._stats
+
+    def _stat(self, name):
+        if self._stats is None:
+            self.computeStats()
+        return self._stats[name]
+
+    std = property(lambda self: self._stat('std'), doc="Standard deviation of the data")
+    mean = property(lambda self: self._stat('mean'), doc="Mean of the data")
+    median = property(lambda self: self._stat('median'), doc="Median of the data")
+    max = property(lambda self: self._stat('max'), doc="Maximum of the data")
+    min = property(lambda self: self._stat('min'), doc="Minimum of the data")
+
+    @property
+    def data(self):
+        """Pixel data as np.ndarray, read from path if it is not in memory"""
+        if self._data is None and self._deferred:
+            self.load()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._stats = None
+
+    @property
+    def header(self):
+        """Full FITS header, read from path if the Frame does not hold it"""
+        if self._header is None and self.path is not None:
+            with fits.open(self.path) as hdul:
+                self._header = imageHDU(hdul).header.copy()
+        return self._header
+
+    @header.setter
+    def header(self, header):
+        self._header = header
+        self._record = tuple(None if header is None else header.get(k) for k in Frame.keywords)
+
+    @property
+    def record(self):
+        """Dictionary of the header keywords kept by the Frame (missing keywords left out)"""
+        return {k: v for k, v in zip(Frame.keywords, self._record) if v is not None}
+
+    @property
+    def shape(self):
+        """(rows, columns) of the data, taken from the header if the data is not in memory"""
+        if self._data is None and self._deferred:
+            record = self.record
+            if 'NAXIS1' in record and 'NAXIS2' in record:
+                return (record['NAXIS2'], record['NAXIS1'])
+            return (self.header['NAXIS2'], self.header['NAXIS1'])
+        return self._data.shape
+
+    def rows(self, start, stop):
+        """Return rows start:stop of the data
+        A deferred Frame that is not in memory only reads these rows from its file
+        """
+        if self._data is None and self._deferred:
+            with fits.open(self.path) as hdul:
+                return imageHDU(hdul).section[start:stop]
+        return self._data[start:stop]
+
+    def section(self, rows, cols):
+        """Return data[rows, cols] for slices rows and cols
+        A deferred Frame that is not in memory only reads these pixels from its file;
+        of a compressed (.fits.fz) file only the tiles that overlap them are decompressed
+        """
+        if self._data is None and self._deferred:
+            with fits.open(self.path) as hdul:
+                return imageHDU(hdul).section[rows, cols]
+        return self._data[rows, cols]
+
+    def load(self):
+        """Read pixel data of a deferred Frame from its file and return it"""
+        if self._data is None:
+            #Memory-mapped by astropy unless the data has to be scaled (BZERO/BSCALE) or is compressed
+            #  (getdata reads extension 1 of compressed files, like imageHDU)
+            self._data = fits.getdata(self.path)
+        return self._data
+
+    def release(self):
+        """Drop pixel data of a deferred Frame; it is read again when needed"""
+        if self._deferred:
+            self._data = None
+
     def __call__(self):
         """Return the data portion of the FITS HDU (np.ndarray; d=2)"""
         return self.data
@@ -85,6 +245,19 @@ class Frame:
     def __repr__(self):
         return self.__str__()
 
+    def __getstate__(self):
+        #Deferred pixels and the full header of a file are read again by the receiver
+        state = {name: getattr(self, name) for name in Frame.__slots__ if hasattr(self, name)}
+        if self._deferred:
+            state['_data'] = None
+        if self.path is not None:
+            state['_header'] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __add__(self, obj):
         return self.data + obj.data
 
@@ -94,8 +267,30 @@ class Frame:
     def __mul__(self, obj):
         return self.data * obj.data
     
-    def __trudiv__(self, obj):
+    def __truediv__(self, obj):
         return self.data / obj.data
+
+    def _inPlace(self):
+        #Data that in-place arithmetic can write to: raw integer or read-only
+        #  (memory-mapped) data is converted to Frame.precision once
+        data = self.data
+        if data.dtype.kind != 'f' or not data.flags.writeable:
+            data = data.astype(Frame.precision)
+        #The data no longer matches the file, so it must not be released
+        self._data = data
+        self._deferred = False
+        self._stats = None
+        return data
+
+    def __isub__(self, obj):
+        data = self._inPlace()
+        np.subtract(data, obj.data if isinstance(obj, Frame) else obj, out=data, casting='unsafe')
+        return self
+
+    def __itruediv__(self, obj):
+        data = self._inPlace()
+        np.divide(data, obj.data if isinstance(obj, Frame) else obj, out=data, casting='unsafe')
+        return self
     
 
 
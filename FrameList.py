@@ -9,12 +9,20 @@ import numpy as np
 from Frame import Frame
 
 class FrameList(list):
+    # Registry of master frames built during this run, keyed on (type, filter, gain, intTime)
+    #  Every FrameList with the same key shares the same master, so each master
+    #  dark/flat/light only has to be combined once per run.
+    _masters = dict()
+
     def __init__(self, frame):
         self.append(frame)
-        self._master = None
         self._masterFlat = None
         self._masterDark = None
 
+    def key(self):
+        """Return (type, filter, gain, intTime) tuple shared by all frames in this list"""
+        return (self[0].type, self[0].filter, self[0].gain, self[0].intTime)
+
     def setDarkFrame(self, darkFrame):
         self._darkFrame = darkFrame
 
@@ -22,10 +30,11 @@ class FrameList(list):
         self._flatFrame = flatFrame
 
     def setMaster(self, frame):
-        self._master = frame
+        FrameList._masters[self.key()] = frame
 
     def getMaster(self):
-        return self._master
+        """Return master frame registered for this list's key, None if not built yet"""
+        return FrameList._masters.get(self.key())
     
     def append(self, frame):
         #If this is the first frame to be added to the list
@@ -56,10 +65,10 @@ class FrameList(list):
     
     def __str__(self):
         """Return string with basic information on FrameList object."""
-        if self._master == None:
+        if self.getMaster() is None:
             s = f"FrameList. {len(self)}x({self[0]})"
         else:
-            s = f"FrameList. {len(self)}x({self._master})"
+            s = f"FrameList. {len(self)}x({self.getMaster()})"
         return s
     
     def getFrameInfo(self):
@@ -0,0 +1,114 @@
+##########################################
+#####  Imports
+##########################################
+
+# Native Imports
+import os, glob, json, hashlib
+
+# Installed Imports
+import numpy as np
+
+class MasterLibrary:
+    """The MasterLibrary Class is an on-disk store of master frames that
+    persists between runs of the pipeline.
+
+    Each entry holds the data and the bad pixel map returned by
+    redux_functions.accumulate and is keyed by a hash of the contributing
+    FITS files (path, size, modification time) and the combine settings.
+    If none of the darks/flats changed since the last run, the master is
+    loaded from disk instead of being re-stacked.
+
+    The library is kept under a size budget (bytes). Entries are evicted in
+    least-recently-used order; the modification time of an entry is bumped
+    every time it is read.
+    """
+
+    # Bump this whenever the way masters are built changes, so old entries miss
+    version = 1
+
+    def __init__(self, directory, maxBytes, logger=None):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.logger = logger
+        os.makedirs(self.directory, exist_ok=True)
+
+    def makeKey(self, frames, listType, **settings):
+        """Return hex digest identifying a master built from frames with settings"""
+        fingerprints = []
+        for frame in frames:
+            stat = os.stat(frame.path)
+            fingerprints.append( (os.path.abspath(frame.path), stat.st_size, stat.st_mtime_ns) )
+
+        description = {"version": self.version, "type": listType,
+                       "files": sorted(fingerprints), "settings": settings}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _dataPath(self, key):
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def _mapPath(self, key):
+        return os.path.join(self.directory, f"{key}_map.npy")
+
+    def get(self, key):
+        """Return (data, badMap) tuple stored under key, or None if not in library"""
+        dataPath, mapPath = self._dataPath(key), self._mapPath(key)
+        if not os.path.exists(dataPath):
+            return None
+
+        data = np.load(dataPath)
+        badMap = np.load(mapPath) if os.path.exists(mapPath) else None
+
+        #Mark entry as recently used
+        os.utime(dataPath)
+        if badMap is not None:
+            os.utime(mapPath)
+
+        if self.logger:
+            self.logger.debug(f"Loaded master {key} from library")
+        return data, badMap
+
+    def put(self, key, data, badMap=None):
+        """Store data and badMap under key, then trim library to size budget"""
+        self._write(self._dataPath(key), data)
+        if badMap is not None:
+            self._write(self._mapPath(key), badMap)
+        if self.logger:
+            self.logger.debug(f"Stored master {key} in library")
+        self.evict()
+
+    def _write(self, path, array):
+        #Write to temporary file first so a killed run never leaves half an entry behind
+        tmpPath = f"{path}.{os.getpid()}.tmp"
+        with open(tmpPath, "wb") as f:
+            np.save(f, array)
+        os.replace(tmpPath, path)
+
+    def size(self):
+        """Return total number of bytes held by the library"""
+        return sum(os.path.getsize(p) for p in glob.glob(os.path.join(self.directory, "*.npy")))
+
+    def evict(self):
+        """Remove least recently used entries until library fits within maxBytes"""
+        entries = {}
+        for path in glob.glob(os.path.join(self.directory, "*.npy")):
+            key = os.path.basename(path).split("_")[0].split(".")[0]
+            #Another process may evict (or write) the same entry concurrently
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            lastUsed, nBytes = entries.get(key, (0, 0))
+            entries[key] = (max(lastUsed, stat.st_mtime_ns), nBytes + stat.st_size)
+
+        total = sum(nBytes for _, nBytes in entries.values())
+        for key, (_, nBytes) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= self.maxBytes:
+                break
+            for path in (self._dataPath(key), self._mapPath(key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= nBytes
+            if self.logger:
+                self.logger.debug(f"Evicted master {key} from library")
@@ -0,0 +1,108 @@
+##########################################
+#####  Imports
+##########################################
+
+# Native Imports
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+class Scheduler:
+    """The Scheduler Class runs a dependency graph of tasks in a pool of
+    worker processes.
+
+    Each task is a module-level function with its arguments, added under a
+    key. An argument Scheduler.Result(key) stands for the return value of
+    the task with that key: the task waits for it and then receives the
+    value itself. Tasks without unfinished dependencies run concurrently,
+    up to jobs at a time. Adding a key twice keeps the first task, so
+    several tasks can depend on one shared task (e.g. a master dark).
+
+    With jobs=1 the tasks run one after another in this process, so
+    nothing is copied. Otherwise arguments and results are pickled to and
+    from the workers, so they should be small plain values (np.ndarrays,
+    numbers, deferred Frames that read their pixels from file).
+
+    A result is only held until every task that depends on it has started.
+    """
+
+    class Result:
+        """Placeholder argument for the result of the task added under key"""
+        def __init__(self, key):
+            self.key = key
+
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+        self._tasks = dict()
+        self._added = 0
+        # Results that tasks still wait for and the number of those tasks
+        self._results = dict()
+        self._dependents = dict()
+        self._done = set()
+
+    def __len__(self):
+        #Number of tasks added
+        return self._added
+
+    def add(self, key, function, *args):
+        """Add task function(*args) under key (unless key was added already) and return key"""
+        if key not in self._tasks and key not in self._done:
+            self._tasks[key] = (function, args)
+            self._added += 1
+            for a in args:
+                if isinstance(a, Scheduler.Result):
+                    self._dependents[a.key] = self._dependents.get(a.key, 0) + 1
+        return key
+
+    def _ready(self, args):
+        return all(a.key in self._done for a in args if isinstance(a, Scheduler.Result))
+
+    def _start(self, key):
+        #Take task key off the graph with its dependencies filled in
+        #  Results no other task waits for any more are dropped
+        function, args = self._tasks.pop(key)
+        values = []
+        for a in args:
+            if isinstance(a, Scheduler.Result):
+                values.append(self._results[a.key])
+                self._dependents[a.key] -= 1
+                if self._dependents[a.key] == 0:
+                    del self._results[a.key]
+            else:
+                values.append(a)
+        return function, values
+
+    def _finish(self, key, result):
+        self._done.add(key)
+        if self._dependents.get(key):
+            self._results[key] = result
+        return result
+
+    def _stuck(self):
+        return Exception(f"Tasks wait for results that are never computed: {list(self._tasks)}")
+
+    def run(self):
+        """Run every added task; yield (key, result) of each task as it finishes
+        Tasks are started in the order they were added, as soon as they are ready.
+        An exception raised by a task is raised here, after the running tasks finished
+        """
+        if self.jobs == 1:
+            while self._tasks:
+                key = next((k for k, (_, args) in self._tasks.items() if self._ready(args)), None)
+                if key is None:
+                    raise self._stuck()
+                function, args = self._start(key)
+                yield key, self._finish(key, function(*args))
+            return
+
+        running = dict()
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            while self._tasks or running:
+                for key in [k for k, (_, args) in self._tasks.items() if self._ready(args)]:
+                    function, args = self._start(key)
+                    running[pool.submit(function, *args)] = key
+                if not running:
+                    raise self._stuck()
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = running.pop(future)
+                    yield key, self._finish(key, future.result())
@@ -0,0 +1,125 @@
+##########################################
+#####  Imports
+##########################################
+
+# Native Imports
+import tempfile
+from multiprocessing import shared_memory
+
+# Installed Imports
+import numpy as np
+
+#Locally authored classes
+from Frame import Frame
+
+class StackCube:
+    """The StackCube Class holds a stack of frames as a single
+    (frames, rows, columns) np.ndarray in native byte order.
+
+    FITS data is big-endian, so every operation on raw frame data has to
+    swap bytes and allocate a new array. Frames are instead copied into the
+    cube exactly once (optionally dark-subtracted and flat-divided on the
+    way in) and all combining is done on views of the cube.
+
+    If a directory is given, the cube is memory-mapped to a scratch file in
+    that directory (e.g. OUTDIR, or /dev/shm for tmpfs), otherwise it lives
+    in memory. With shared=True an in-memory cube is allocated as shared
+    memory. Cubes backed by a scratch file or shared memory can be attached
+    by worker processes through spec() without pickling any pixels. The
+    scratch file/shared memory is removed when the cube is closed.
+
+    Indexing a StackCube returns the 2D np.ndarray of that frame.
+    """
+
+    def __init__(self, nFrames, shape, dtype, directory=None, shared=False):
+        dtype = np.dtype(dtype).newbyteorder('=')
+        self._file, self._shm = None, None
+        if directory is not None:
+            self._file = tempfile.NamedTemporaryFile(dir=directory, prefix="stack_")
+            self.cube = np.memmap(self._file.name, mode='w+', shape=(nFrames, *shape), dtype=dtype)
+        elif shared:
+            nBytes = max(1, nFrames * int(np.prod(shape)) * dtype.itemsize)
+            self._shm = shared_memory.SharedMemory(create=True, size=nBytes)
+            self.cube = np.ndarray((nFrames, *shape), dtype=dtype, buffer=self._shm.buf)
+        else:
+            self.cube = np.empty((nFrames, *shape), dtype=dtype)
+        self.count = 0
+
+    @classmethod
+    def fromFrames(cls, frames, directory=None, shared=False):
+        """Return StackCube holding the data of frames (Frames or np.ndarrays) in their (native) data type"""
+        first = frames[0].data if isinstance(frames[0], Frame) else np.asarray(frames[0])
+        stack = cls(len(frames), first.shape, first.dtype, directory, shared)
+        for f in frames:
+            if isinstance(f, Frame):
+                stack.append(f.data)
+                f.release()
+            else:
+                stack.append(f)
+        return stack
+
+    def spec(self):
+        """Return picklable description used by attach(), None if the cube is private memory"""
+        if self._file is not None:
+            return ('file', self._file.name, self.cube.shape, self.cube.dtype.str, self.count)
+        if self._shm is not None:
+            return ('shm', self._shm.name, self.cube.shape, self.cube.dtype.str, self.count)
+        return None
+
+    @staticmethod
+    def attach(spec):
+        """Return (cube, handle) for a spec() made in another process; close handle when done"""
+        kind, name, shape, dtype, count = spec
+        if kind == 'file':
+            return np.memmap(name, mode='r+', shape=shape, dtype=dtype)[:count], None
+        try:
+            #Python >= 3.13: do not let this process' resource tracker remove the memory
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)[:count], shm
+
+    def append(self, data, subtract=None, divide=None):
+        """Copy data into the next slot of the cube, computing (data-subtract)/divide in place"""
+        slot = self.cube[self.count]
+        if subtract is None:
+            np.copyto(slot, data, casting='unsafe')
+        else:
+            np.subtract(data, subtract, out=slot, casting='unsafe')
+        if divide is not None:
+            np.divide(slot, divide, out=slot, casting='unsafe')
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.cube[:self.count][i]
+
+    def __iter__(self):
+        return iter(self.cube[:self.count])
+
+    def strip(self, start, stop):
+        """Return (frames, stop-start, columns) view of rows start:stop of every frame"""
+        return self.cube[:self.count, start:stop]
+
+    def close(self):
+        """Release the cube (and its scratch file or shared memory)"""
+        self.cube = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                #Views of the cube are still around, memory is freed once they are gone
+                pass
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
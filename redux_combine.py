@@ -0,0 +1,449 @@
+##########################################
+#####  Imports
+##########################################
+
+# Native Imports
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import warnings
+
+# Installed Imports
+import numpy as np
+
+#Locally authored classes
+from Frame import Frame
+from StackCube import StackCube
+from CalibratedFrames import CalibratedFrames
+
+"""
+Pixel-wise combination of stacks of frames.
+These functions do the heavy lifting for redux_functions.accumulate.
+
+Several combine engines are available (see engines at the bottom):
+median - exact pixel-wise median of the whole stack, computed in strips
+sigmaclip - mean of the values within 3 robust std of the median, also in strips
+mean, minmax - streaming engines that read one frame at a time
+    (or take them from a CalibratedFrames stage), so they only ever hold a
+    few frames worth of running sums in memory
+Every engine returns (combined, scatter), scatter being a pixel-wise
+robust standard deviation through the stack used to find noisy pixels:
+1.4826*MAD for the median and sigmaclip, the standard deviation without
+each pixel's lowest and highest value for the streaming engines. Either
+way a single cosmic ray does not make a pixel noisy.
+
+Stacks of raw unsigned integer frames (16-bit camera data: darks, biases,
+flats) are median-combined without any floating point, see _integerStrip.
+
+Unless it is already a StackCube, the stack is never held in memory all at
+once. Instead it is combined in strips of image rows, each strip sized so that the strip of every frame
+(plus the workspace NumPy needs) fits within a memory budget in bytes.
+Each strip is written into a preallocated output frame.
+"""
+
+def _rows(f, start, stop):
+    #Rows start:stop of a Frame (possibly read from disk) or of a plain np.ndarray
+    if isinstance(f, Frame):
+        return f.rows(start, stop)
+    return np.asarray(f)[start:stop]
+
+def _frameShape(frames):
+    #(rows, columns) of the frames without calibrating or reading one
+    if isinstance(frames, CalibratedFrames):
+        return frames.shape
+    return frames[0].shape
+
+def _dtype(frames):
+    #Data type of the stack, frames that are not in memory only read their first row
+    if isinstance(frames, StackCube):
+        return frames.cube.dtype
+    if isinstance(frames, CalibratedFrames):
+        return frames.dtype
+    return _rows(frames[0], 0, 1).dtype
+
+def isRawInteger(frames):
+    """Return True if frames (Frames, np.ndarrays or a StackCube) hold unsigned integers of at most 16 bit"""
+    dtype = _dtype(frames)
+    return dtype.kind == 'u' and dtype.itemsize <= 2
+
+def rowsPerStrip(frames, memory=None):
+    """Return number of image rows combined at once so a strip of the stack fits in memory bytes
+    memory=None means the whole frame is a single strip
+    """
+    nRows, nCols = _frameShape(frames)
+    if memory is None:
+        return nRows
+
+    dtype = _dtype(frames)
+    if dtype.kind == 'u' and dtype.itemsize <= 2:
+        #The strip itself and the output rows, the integer median works in
+        #  tiles of integerTile pixels whose workspace does not depend on the strip
+        bytesPerRow = nCols * (len(frames) * dtype.itemsize + 16)
+    else:
+        #The strip itself, the copy np.median partitions in, the float64
+        #  deviations of the scatter (see _robustStd), and the output rows
+        bytesPerRow = nCols * (len(frames) * (2 * dtype.itemsize + 8) + 16)
+    return int(max(1, min(nRows, memory // bytesPerRow)))
+
+def strips(frames, memory=None):
+    """Yield (start, stop, cube) for consecutive row strips of the stack
+    cube is a (len(frames), stop-start, columns) np.ndarray
+    A CalibratedFrames stage is calibrated one strip at a time.
+    """
+    nRows = _frameShape(frames)[0]
+    step = rowsPerStrip(frames, memory)
+    for start in range(0, nRows, step):
+        stop = min(start + step, nRows)
+        if isinstance(frames, StackCube):
+            #Already stacked, no copy needed
+            yield start, stop, frames.strip(start, stop)
+        elif isinstance(frames, CalibratedFrames):
+            yield start, stop, frames.rows(start, stop)
+        else:
+            yield start, stop, np.stack([_rows(f, start, stop) for f in frames])
+
+def _outputType(dtype):
+    #np.median keeps float types and promotes integers to float64
+    return dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+
+# Number of pixels the integer median works on at once, small enough that
+#  a tile of a 50 frame stack stays in the CPU cache for every pass over it
+integerTile = 4096
+
+def _middleValues(values, below, count):
+    #Lower and upper middle value of each column of values (unsigned integers), by radix selection:
+    #  the value of rank k of each column is built one bit at a time, most
+    #  significant first, by counting how many of the column's values lie below
+    #  the candidate value. That is a histogram of two bins per bit, made of
+    #  comparisons and sums of small integers only.
+    #  below is a bool workspace of the same shape, count an integer type that can count to len(values)
+    n = len(values)
+    k = (n - 1) // 2
+    unsigned = values.dtype.type
+
+    #value = largest candidate with at most k values below it = value of rank k
+    value = np.zeros(values.shape[1], dtype=values.dtype)
+    for bit in reversed(range(int(values.max()).bit_length())):
+        candidate = value | unsigned(1 << bit)
+        np.less(values, candidate, out=below)
+        nBelow = np.add.reduce(below.view(np.uint8), axis=0, dtype=count)
+        np.copyto(value, candidate, where=nBelow <= k)
+    if n % 2 == 1:
+        return value, value
+
+    #The upper middle value is the same one if more than k+1 values are <= it,
+    #  otherwise it is the smallest value above it
+    np.less_equal(values, value, out=below)
+    nBelow = np.add.reduce(below.view(np.uint8), axis=0, dtype=count)
+    above = np.maximum(values, np.multiply(below, np.iinfo(values.dtype).max, dtype=values.dtype)).min(axis=0)
+    return value, np.where(nBelow > k + 1, value, above)
+
+def _integerStrip(cube, out, scatter=None):
+    #Exact pixel-wise median (and robust scatter) of a strip of unsigned integer frames
+    #  The pixel's minimum is subtracted first so the radix selection (see
+    #  _middleValues) only needs the bits of its range. The scatter is
+    #  1.4826*MAD: the deviations from twice the median are integers, so
+    #  their median is found the same way.
+    n = len(cube)
+    values = cube.reshape(n, -1)
+    median = np.empty(values.shape[1], dtype=out.dtype)
+    sigma = np.empty(values.shape[1], dtype=scatter.dtype) if scatter is not None else None
+    #An integer type that can count to n
+    count = np.uint8 if n < 2**8 else np.uint16 if n < 2**16 else np.uint32
+
+    for start in range(0, values.shape[1], integerTile):
+        tile = values[:, start:start + integerTile]
+        stop = start + tile.shape[1]
+        low = tile.min(axis=0)
+        offsets = np.subtract(tile, low, dtype=np.uint16)
+        below = np.empty(tile.shape, dtype=bool)
+
+        value, upper = _middleValues(offsets, below, count)
+        np.add(value, low, out=median[start:stop])
+        if n % 2 == 0:
+            median[start:stop] += (upper.astype(median.dtype) - value) / 2
+
+        if sigma is not None:
+            #|2*x - 2*median| fits in 17 bits
+            twiceMedian = value.astype(np.int32) + upper
+            deviations = np.abs(2 * offsets.astype(np.int32) - twiceMedian).view(np.uint32)
+            value, upper = _middleValues(deviations, below, count)
+            np.multiply(value.astype(np.float64) + upper, 1.4826 / 4, out=sigma[start:stop], casting='unsafe')
+
+    out[...] = median.reshape(out.shape)
+    if sigma is not None:
+        scatter[...] = sigma.reshape(scatter.shape)
+
+def _robustStd(cube, center, out):
+    #Pixel-wise 1.4826*MAD around center: the standard deviation of normally
+    #  distributed values, but not raised by a few outliers (e.g. cosmic rays)
+    #  The deviations are the one float64 copy of the strip, partitioned in place
+    deviations = np.subtract(cube, center, dtype=np.float64)
+    np.abs(deviations, out=deviations)
+    np.multiply(np.median(deviations, axis=0, overwrite_input=True), 1.4826, out=out, casting='unsafe')
+
+def _combineStrip(cube, out, scatter=None):
+    #Pixel-wise median (and robust scatter) of a strip of the stack
+    if cube.dtype.kind == 'u' and cube.dtype.itemsize <= 2:
+        return _integerStrip(cube, out, scatter)
+    np.median(cube, axis=0, out=out)
+    if scatter is not None:
+        _robustStd(cube, out, scatter)
+
+def median(frames, memory=None, workers=1, scatter=False, dtype=None):
+    """Return pixel-wise median of frames (Frames, 2D np.ndarrays, a StackCube or a CalibratedFrames stage)
+    Identical to np.median([f.data for f in frames], axis=0), but combined in
+    row strips that fit in memory bytes. With dtype given, the median is
+    stored in that type instead of the type np.median would return.
+    With workers > 1 the strips are combined by a pool of worker processes.
+    With scatter=True, return (median, scatter) where scatter is the float32
+        pixel-wise 1.4826*MAD through the stack, computed from the same strips.
+    """
+    if workers > 1:
+        return _parallelMedian(frames, memory, workers, scatter, dtype)
+
+    out, sigma = None, None
+    for start, stop, cube in strips(frames, memory):
+        if out is None:
+            out = np.empty(_frameShape(frames), dtype=dtype or _outputType(cube.dtype))
+            sigma = np.empty(_frameShape(frames), dtype=np.float32) if scatter else None
+        _combineStrip(cube, out[start:stop], None if sigma is None else sigma[start:stop])
+    return (out, sigma) if scatter else out
+
+def _medianStrip(stackSpec, outSpec, scatterSpec, start, stop):
+    #Worker process: median (and scatter) of rows start:stop of a shared stack into shared outputs
+    cube, cubeHandle = StackCube.attach(stackSpec)
+    out, outHandle = StackCube.attach(outSpec)
+    sigma, sigmaHandle = StackCube.attach(scatterSpec) if scatterSpec else (None, None)
+    _combineStrip(cube[:, start:stop], out[0, start:stop], None if sigma is None else sigma[0, start:stop])
+    del cube, out, sigma
+    for handle in (cubeHandle, outHandle, sigmaHandle):
+        if handle is not None:
+            handle.close()
+
+def _parallelMedian(frames, memory, workers, scatter=False, dtype=None):
+    #The stack and the outputs are placed in shared memory (or a scratch file),
+    #  so the workers only receive row ranges and never any pixels
+    if isinstance(frames, StackCube) and frames.spec() is not None:
+        stack = frames
+    else:
+        stack = StackCube.fromFrames(frames, shared=True)
+
+    nRows, nCols = stack[0].shape
+    #Every worker combines a strip at the same time, so they share the memory budget
+    step = rowsPerStrip(stack, None if memory is None else memory / workers)
+    #Keep a few strips per worker so they all stay busy until the end
+    step = max(1, min(step, -(-nRows // (4 * workers))))
+    starts = list(range(0, nRows, step))
+    stops = [min(start + step, nRows) for start in starts]
+
+    try:
+        with StackCube(1, (nRows, nCols), dtype or _outputType(stack.cube.dtype), shared=True) as out, \
+             StackCube(1, (nRows, nCols) if scatter else (0, 0), np.float32, shared=True) as sigma:
+            #The single output frames are filled in by the workers instead of appended
+            out.count = sigma.count = 1
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(_medianStrip, repeat(stack.spec()), repeat(out.spec()), \
+                              repeat(sigma.spec() if scatter else None), starts, stops))
+            combined = np.array(out[0])
+            scatterMap = np.array(sigma[0]) if scatter else None
+    finally:
+        if stack is not frames:
+            stack.close()
+    return (combined, scatterMap) if scatter else combined
+
+def _each(frames):
+    #Yield the data of one frame at a time, frames read from disk are released after use
+    for f in frames:
+        if isinstance(f, Frame):
+            yield f.data
+            f.release()
+        else:
+            yield np.asarray(f)
+
+class _RunningMoments:
+    #Welford running pixel-wise mean and sum of squared deviations (M2),
+    #  and the lowest and highest value of each pixel
+    #  All work is done in preallocated buffers, no arrays are allocated per frame
+    def __init__(self, shape, dtype=np.float64):
+        self.n = 0
+        self.mean = np.zeros(shape, dtype=dtype)
+        self.M2 = np.zeros(shape, dtype=dtype)
+        self.low = np.full(shape, np.inf, dtype=dtype)
+        self.high = np.full(shape, -np.inf, dtype=dtype)
+        self.x = np.empty(shape, dtype=dtype)
+        self._delta = np.empty(shape, dtype=dtype)
+        self._step = np.empty(shape, dtype=dtype)
+
+    def add(self, data):
+        #Copies data into x (native byte order, float); x is left holding data - new mean
+        self.n += 1
+        np.copyto(self.x, data, casting='unsafe')
+        np.subtract(self.x, self.mean, out=self._delta)
+        np.divide(self._delta, self.n, out=self._step)
+        self.mean += self._step
+        np.subtract(self.x, self.mean, out=self.x)
+        np.multiply(self._delta, self.x, out=self._step)
+        self.M2 += self._step
+        #x holds data - mean, so compare against the raw data
+        np.minimum(self.low, data, out=self.low, casting='unsafe')
+        np.maximum(self.high, data, out=self.high, casting='unsafe')
+
+    def rejectedMean(self):
+        return (self.mean * self.n - self.low - self.high) / (self.n - 2)
+
+    def rejectedStd(self):
+        #Standard deviation without the lowest and highest value (all values for fewer than 3)
+        #  Taking values a, b out of M2 about the mean m leaves
+        #  M2 - (a-m)^2 - (b-m)^2 - (a-m + b-m)^2/(n-2) about the new mean
+        if self.n < 3:
+            return np.sqrt(self.M2 / self.n).astype(np.float32)
+        lowDelta, highDelta = self.low - self.mean, self.high - self.mean
+        M2 = self.M2 - lowDelta**2 - highDelta**2 - (lowDelta + highDelta)**2 / (self.n - 2)
+        return np.sqrt(np.maximum(M2, 0) / (self.n - 2)).astype(np.float32)
+
+def mean(frames, memory=None, workers=1, dtype=np.float64):
+    """Return (pixel-wise mean, scatter) of frames, reading one frame at a time
+    scatter is the standard deviation without each pixel's lowest and highest value
+    """
+    moments = _RunningMoments(_frameShape(frames), dtype)
+    for data in _each(frames):
+        moments.add(data)
+    return moments.mean, moments.rejectedStd()
+
+def sigmaClippedMean(frames, memory=None, workers=1, dtype=np.float64, numStd=3):
+    """Return (pixel-wise sigma-clipped mean, 1.4826*MAD) of frames, combined in row strips (see strips)
+    Values more than numStd robust standard deviations (1.4826*MAD) from the
+    pixel-wise median are left out of the mean. The median and MAD are not
+    pulled along by the outliers themselves, unlike the mean and std: one
+    outlier among n values is at most (n-1)/sqrt(n) std from their mean, so a
+    clip around the mean rejects nothing for stacks of 10 frames or fewer.
+    """
+    out, sigma = None, None
+    for start, stop, cube in strips(frames, memory):
+        if out is None:
+            out = np.empty(_frameShape(frames), dtype=dtype)
+            sigma = np.empty(_frameShape(frames), dtype=np.float32)
+        center = np.median(cube, axis=0)
+        distance = np.abs(cube - center)
+        spread = 1.4826 * np.median(distance, axis=0)
+        sigma[start:stop] = spread
+        keep = distance <= numStd * spread
+        #At least half of the values are within one MAD of the median, so count > 0
+        total = np.sum(cube, axis=0, dtype=np.float64, where=keep)
+        np.divide(total, np.count_nonzero(keep, axis=0), out=out[start:stop], casting='unsafe')
+    return out, sigma
+
+def minMaxRejectedMean(frames, memory=None, workers=1, dtype=np.float64):
+    """Return (pixel-wise mean and standard deviation without the lowest and highest value) of frames,
+    reading one frame at a time. Needs at least three frames.
+    """
+    if len(frames) < 3:
+        raise Exception(f"Min/max rejection needs at least 3 frames, got {len(frames)}")
+
+    moments = _RunningMoments(_frameShape(frames), dtype)
+    for data in _each(frames):
+        moments.add(data)
+    return moments.rejectedMean(), moments.rejectedStd()
+
+def medianWithScatter(frames, memory=None, workers=1, dtype=None):
+    """Return (pixel-wise median, 1.4826*MAD) of frames, see median"""
+    return median(frames, memory, workers, scatter=True, dtype=dtype)
+
+# Combine engines selectable with --combine, all called as engine(frames, memory, workers, dtype)
+engines = {
+    'median': medianWithScatter,
+    'mean': mean,
+    'sigmaclip': sigmaClippedMean,
+    'minmax': minMaxRejectedMean,
+}
+
+# Engines that read frames one at a time and never need the whole stack
+streamingEngines = ('mean', 'minmax')
+
+def _boxes(n, block):
+    #First pixel of every box along an axis of n pixels; the last box ends at the edge
+    starts = np.arange(0, n - block + 1, block)
+    if starts[-1] + block < n:
+        starts = np.append(starts, n - block)
+    return starts
+
+def _interpolation(n, centers):
+    #Indices of the two centers around each of n pixels and the weight of the second,
+    #  for linear interpolation (centers holds one extra center at each end)
+    pixels = np.arange(n)
+    lower = np.clip(np.searchsorted(centers, pixels, side='right') - 1, 0, len(centers) - 2)
+    weight = (pixels - centers[lower]) / (centers[lower + 1] - centers[lower])
+    return lower, lower + 1, weight.astype(np.float32)
+
+def localLevel(values, block=32):
+    """Return smooth map of the typical value of values around every pixel
+    The median of the finite pixels in every block x block box (sampling every
+    other row and column), interpolated
+    linearly between the box centers back to full resolution (and extrapolated
+    linearly to the frame edges), so large-scale structure (vignetting,
+    gradients, amp glow) is followed but single pixels and small clusters of
+    them (a few percent of a box) are not.
+    """
+    rows, cols = values.shape
+    block = max(2, min(block, rows, cols))
+    rowStarts, colStarts = _boxes(rows, block), _boxes(cols, block)
+    #Every box gathered into a row of pixels, every other row and column is plenty for its median
+    offsets = np.arange(0, block, 2)
+    rowIndex, colIndex = (rowStarts[:, np.newaxis] + offsets).ravel(), (colStarts[:, np.newaxis] + offsets).ravel()
+    gathered = values[np.ix_(rowIndex, colIndex)].astype(np.float32)
+    nRows, nCols = len(rowStarts), len(colStarts)
+    boxes = gathered.reshape(nRows, len(offsets), nCols, len(offsets)).transpose(0, 2, 1, 3).reshape(nRows * nCols, -1)
+
+    #Vectorized median of all boxes, nanmedian only for the (few) boxes with non-finite pixels
+    coarse = np.median(boxes, axis=1)
+    partial = np.flatnonzero(np.isnan(coarse))
+    if len(partial):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            coarse[partial] = np.nanmedian(boxes[partial], axis=1)
+    coarse = coarse.reshape(nRows, nCols)
+    coarse[np.isnan(coarse)] = np.nanmedian(coarse) if not np.isnan(coarse).all() else 0.0
+
+    #One more box on every side, continuing the slope of the outermost boxes
+    coarse = np.pad(coarse, 1, mode='reflect', reflect_type='odd')
+    def centers(starts):
+        c = starts + offsets.mean()
+        step = c[1] - c[0] if len(c) > 1 else block
+        last = c[-1] - c[-2] if len(c) > 1 else block
+        return np.concatenate(([c[0] - step], c, [c[-1] + last]))
+
+    #Linear interpolation along columns, then along rows
+    left, right, w = _interpolation(cols, centers(colStarts))
+    coarse = coarse[:, left] * (1 - w) + coarse[:, right] * w
+    top, bottom, w = _interpolation(rows, centers(rowStarts))
+    return coarse[top] * (1 - w)[:, np.newaxis] + coarse[bottom] * w[:, np.newaxis]
+
+def goodPixelMask(level, scatter, listType=None, numStd=3):
+    """Return boolean map that is True for good pixels
+    level - pixel-wise median of the stack
+    scatter - pixel-wise robust standard deviation through the stack, so
+        pixels hit by a cosmic ray in a single frame are not noisy
+    Pixels are compared to their local typical level and scatter (see
+    localLevel), in units of the local robust spread of the differences, so
+    vignetting in flats or gradients and amp glow in darks are not flagged.
+    For darks and flats, a pixel is bad if its level is more than numStd
+    robust standard deviations from the local level (hot, cold and dead
+    pixels) or its scatter through the stack is that far above the local
+    scatter (noisy pixels). Lights contain stars, so only pixels without a
+    finite value are flagged.
+    """
+    goodMask = np.isfinite(level)
+    if listType not in ("dark", "flat"):
+        return goodMask
+
+    for values in (level, scatter):
+        local = localLevel(values)
+        residual = values - local
+        #1.4826*MAD is the standard deviation of normally distributed values
+        #  (a few float32 rounding steps allowed for frames without any scatter)
+        limit = numStd * 1.4826 * localLevel(np.abs(residual)) + 4 * np.finfo(np.float32).eps * np.abs(local)
+        if values is level:
+            goodMask &= np.abs(residual) <= limit
+        else:
+            goodMask &= residual <= limit
+    return goodMask
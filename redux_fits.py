@@ -0,0 +1,103 @@
+##########################################
+#####  Imports
+##########################################
+
+# Native Imports
+import os, datetime
+
+# Installed Imports
+import numpy as np
+from astropy.io import fits
+
+from Frame import Frame
+
+"""
+Master frames and bad pixel maps as tile-compressed FITS files.
+
+A master file has an empty primary HDU whose header records where the
+master came from (type, filter, gain, integration time, combine settings,
+the raw frames and the masters used to calibrate them), a 'MASTER' image
+extension and a 'BADPIX' extension (1 for bad pixels, as usual for FITS
+masks; Frame.badMap is True for good pixels).
+
+The master is compressed losslessly (GZIP_2) unless a quantize level is
+given, then it is quantized to that fraction of its noise and Rice
+compressed. The bad pixel map is always Rice compressed, which shrinks
+it to a few percent of its size. Tiles are square, so a cutout only
+decompresses the tiles it overlaps.
+"""
+
+# Side of the square compression tiles in pixels
+tileSide = 256
+
+def masterHeader(kind, frames, combine=None, precision=None, parents=None):
+    """Return FITS header recording the provenance of a master of kind (dark|flat|light)
+    combined from frames. parents maps header keywords (e.g. DARKFILE) to the files
+    of the masters the frames were calibrated with.
+    """
+    header = fits.Header()
+    header['FRAMETYP'] = ('master', 'Combined frame')
+    header['MASTTYPE'] = (kind, 'Type of the combined frames')
+    if frames[0].filter is not None:
+        header['FILTER'] = frames[0].filter
+    header['GAIN'] = frames[0].gain
+    header['EXPTIME'] = (frames[0].intTime, '[s] Exposure time of the combined frames')
+    header['NCOMBINE'] = (len(frames), 'Number of frames combined')
+    if combine is not None:
+        header['COMBINE'] = (combine, 'Combine method')
+    if precision is not None:
+        header['PRECISN'] = (str(precision), 'Floating point type of the combine')
+    for keyword, path in (parents or {}).items():
+        header[keyword] = os.path.basename(path)
+    header['DATE'] = (datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"), 'UTC date the file was written')
+
+    #IRAF convention: one IMCMBnnn keyword per combined file (only room for 999)
+    for i, frame in enumerate(frames[:999]):
+        if frame.path is not None:
+            header[f'IMCMB{i+1:03d}'] = os.path.basename(frame.path)
+    return header
+
+def _tileShape(shape):
+    return tuple(min(tileSide, n) for n in shape)
+
+def writeMaster(path, master, header, quantize=None):
+    """Write master, a (data, good pixel map) tuple, with provenance header to path
+    quantize - None for lossless compression of the data, otherwise the
+        quantization level (noise / quantize is the step of the stored values)
+    Returns path.
+    """
+    data, badMap = master
+    if quantize is None:
+        dataHDU = fits.CompImageHDU(data, name='MASTER', compression_type='GZIP_2', quantize_level=0.0, \
+                                    tile_shape=_tileShape(data.shape))
+    else:
+        dataHDU = fits.CompImageHDU(data, name='MASTER', compression_type='RICE_1', quantize_level=quantize, \
+                                    tile_shape=_tileShape(data.shape))
+    hdus = [fits.PrimaryHDU(header=header), dataHDU]
+    if badMap is not None:
+        hdus.append(fits.CompImageHDU((~badMap).astype(np.uint8), name='BADPIX', compression_type='RICE_1', \
+                                      tile_shape=_tileShape(badMap.shape)))
+
+    #Write to temporary file first so a killed run never leaves half a master behind
+    tmpPath = f"{path}.{os.getpid()}.tmp"
+    fits.HDUList(hdus).writeto(tmpPath, overwrite=True)
+    os.replace(tmpPath, path)
+    return path
+
+def readMaster(path):
+    """Return master Frame read from a file written by writeMaster
+    The Frame is deferred: the master is only decompressed when its data is
+    used, and rows() and section() only decompress the tiles they overlap.
+    The bad pixel map is read right away (badMap). header is the primary
+    header with the provenance, plus the shape of the master.
+    """
+    with fits.open(path) as hdul:
+        header = hdul[0].header.copy()
+        for keyword in ('NAXIS1', 'NAXIS2'):
+            header[keyword] = hdul['MASTER'].header[keyword]
+        badMap = hdul['BADPIX'].data == 0 if 'BADPIX' in hdul else None
+    master = Frame(None, type='master', filter=header.get('FILTER'), gain=header.get('GAIN'), \
+                   intTime=header.get('EXPTIME'), header=header, badMap=badMap, path=path)
+    #Frames read from a file otherwise read the header of the image extension when asked for
+    master.header = header
+    return master
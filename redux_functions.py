@@ -1,12 +1,19 @@
-import glob, tqdm, astropy
+import os, glob, tqdm, astropy
 import numpy as np
 
 from scipy.optimize import curve_fit
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
-from Frame import Frame
+from Frame import Frame, imageHDU
 from FrameList import FrameList
+from FITSCatalog import FITSCatalog
+from StackCube import StackCube
+from CalibratedFrames import CalibratedFrames
+import redux_combine
+import redux_photometry
+import redux_plots
 
 
 def setProgramArguments(params):
@@ -63,6 +70,116 @@ def setProgramArguments(params):
                         help="Force reduction pipeline to not use darks"
                         )
 
+    # Statistics Flag
+    parser.add_argument('--stats-exclude-bad', default=False, action='store_true',\
+                        help="Leave pixels flagged in the bad pixel map out of frame statistics"
+                        )
+
+    # Lazy Flag
+    parser.add_argument('--lazy', default=False, action='store_true',\
+                        help="Only read FITS headers while scanning, pixel data is read when it is needed"
+                        )
+
+    # Number of threads used to read FITS files
+    parser.add_argument('--workers', '-j', default=8, action='store', metavar="int",\
+                        help="Number of threads used to read FITS files",\
+                        type=int
+                        )
+
+    # FITS Catalog Flags
+    parser.add_argument('--no-catalog', default=False, action='store_true',\
+                        help="Parse every FITS header instead of using the catalog of earlier scans"
+                        )
+    parser.add_argument('--catalog', default=None, action='store', metavar="file",\
+                        help="SQLite catalog of scanned FITS files. Defaults to OUTDIR/catalog.sqlite",\
+                        type=str
+                        )
+
+    # Combine engine
+    parser.add_argument('--combine', default="median", action='store', metavar="engine",\
+                        help="How stacks are combined: median, mean, sigmaclip (mean clipped at 3 robust sigma around the median) or minmax (mean without lowest and highest value). "+\
+                             "mean and minmax read one frame at a time",\
+                        choices=['median', 'mean', 'sigmaclip', 'minmax'])
+
+    # Memory budget for combining frames
+    parser.add_argument('--memory', default=1024, action='store', metavar="MB",\
+                        help="Memory in MB a stack of frames may use while it is combined. Larger stacks are combined in strips of rows",\
+                        type=float
+                        )
+
+    # Scratch directory for stacks of frames
+    parser.add_argument('--scratchdir', default=None, action='store', metavar="dir",\
+                        help="Directory (e.g. OUTDIR or /dev/shm) for memory-mapped stacks of frames. Stacks are kept in memory if not given",\
+                        type=str
+                        )
+
+    # Number of processes used to combine stacks
+    parser.add_argument('--processes', '-P', default=1, action='store', metavar="int",\
+                        help="Number of processes that combine strips of a stack in parallel (1: combine in this process)",\
+                        type=int
+                        )
+
+    # Master Library Flags
+    parser.add_argument('--no-cache', default=False, action='store_true',\
+                        help="Always rebuild master frames instead of using the master library"
+                        )
+    parser.add_argument('--cachedir', default=None, action='store', metavar="dir",\
+                        help="Directory of the master library. Defaults to OUTDIR/masters",\
+                        type=str
+                        )
+    parser.add_argument('--cachesize', default=4096, action='store', metavar="MB",\
+                        help="Size budget of the master library in MB. Least recently used masters are evicted",\
+                        type=float
+                        )
+
+    parser.add_argument('--precision', default="float32", action='store',\
+                        help="Floating point type of calibrated frames and masters. float32 halves memory and bandwidth",\
+                        choices=["float32", "float64"]
+                        )
+
+    parser.add_argument('--check-precision', default=False, action='store_true',\
+                        help="Also combine every master light in float64 and log its largest difference to the --precision result"
+                        )
+
+    parser.add_argument('--jobs', default=1, action='store', metavar="N",\
+                        help="Number of worker processes that build masters and extract sources. "+\
+                             "Independent (filter, gain, intTime) groups are reduced concurrently",\
+                        type=int
+                        )
+
+    parser.add_argument('--fwhm', default=None, action='store', metavar="PX",\
+                        help="FWHM in pixels of the source detection kernel (default: estimated from each master light)",\
+                        type=float
+                        )
+
+    parser.add_argument('--detect-tile', default=0, action='store', metavar="PX",\
+                        help="Search master lights larger than PX pixels for sources in PX x PX tiles (default 0: whole frame)",\
+                        type=int
+                        )
+
+    parser.add_argument('--detect-processes', default=1, action='store', metavar="N",\
+                        help="Number of processes that search the tiles of a master light (--detect-tile)",\
+                        type=int
+                        )
+
+    parser.add_argument('--no-masters', default=False, action='store_true',\
+                        help="Do not write the master frames and bad pixel maps to OUTDIR"
+                        )
+
+    parser.add_argument('--quantize', default=None, action='store', metavar="Q",\
+                        help="Quantize written masters to noise/Q steps (Rice) instead of lossless compression",\
+                        type=float
+                        )
+
+    parser.add_argument('--no-plots', default=False, action='store_true',\
+                        help="Do not draw diagnostic plots (pyplot is not imported and no figures are drawn)"
+                        )
+
+    parser.add_argument('--plot-processes', default=2, action='store', metavar="N",\
+                        help="Number of background processes that draw diagnostic plots",\
+                        type=int
+                        )
+
     # Specify Version flag
     parser.add_argument('--version', '-V', '-version', action='version', version='%(prog)s Version 0.0, 20231129')
 
@@ -100,58 +217,130 @@ def setProgramArguments(params):
 
     parser.parse_args(namespace=params)
 
+def _makeFrame(params, header, data, fitsFile):
+    #Build Frame from the values in header, None if the file should be skipped
+    #  header is a FITS header or the keywords of a catalog record
+    #Carve-out for bias and dark frames for which header does not report filter
+    try:
+        #Check to see if this filter was specified to be skipped
+        if header['FILTER'].upper().strip() in params.excludeFilter[0]:
+            return None
+        if header['FRAMETYP'].lower().strip() == "flat" and params.no_flat:
+            return None
+        if header['FRAMETYP'].lower().strip() == 'badpx':
+            return None
+
+        frame = Frame(data, header['FRAMETYP'].lower(), header['FILTER'].upper(), \
+                    header['GAIN'], header['EXPTIME'], header, path=fitsFile
+                    )
+                                    
+    except Exception as e: #We expect bias and dark frames to fail to resolve the 'FILTER' key in the header
+        frame = Frame(data, type=header['FRAMETYP'].lower(), filter=None, \
+                        gain=header['GAIN'], intTime=header['EXPTIME'], header=header, path=fitsFile
+                        )
+    return frame
+
+def readFITS(params, fitsFile, record=None):
+    """Return (Frame, catalog record) for fitsFile. Frame is None if the file should be skipped
+    record is the catalog entry from an earlier scan. If the file did not change since,
+        the header is not parsed again and the Frame reads its full header on demand.
+    """
+    stat = os.stat(fitsFile)
+    if FITSCatalog.isCurrent(record, stat):
+        #Header-only scan: pixels are read when the Frame data is first used
+        data = None if params.lazy else astropy.io.fits.getdata(fitsFile)
+        return _makeFrame(params, FITSCatalog.header(record), data, fitsFile), record
+
+    with astropy.io.fits.open(fitsFile) as hdul:
+        #Compressed (.fits.fz) files hold the image in extension 1
+        hdu = imageHDU(hdul)
+        data = None if params.lazy else hdu.data
+        frame = _makeFrame(params, hdu.header, data, fitsFile)
+        record = FITSCatalog.makeRecord(fitsFile, stat, hdu.header)
+    return frame, record
+
+def addFrame(params, fitsFiles, frame):
+    """Add frame to the FrameList at fitsFiles[frame.type][frame.filter][frame.gain][frame.intTime]"""
+    #Create all of the dictionaries!
+    try:
+        #If frameList for filter is alr defined ...
+        fitsFiles[frame.type][frame.filter][frame.gain][frame.intTime].append(frame)
+        #print(f"Added frame {str(frame)} to dictionary!")
+    except KeyError as e: #Couldn't find FrameList for that intTime, trying to add new FrameList for intTime
+        try:
+            fitsFiles[frame.type][frame.filter][frame.gain][frame.intTime] = FrameList(frame)
+        except KeyError as e: #Couldn't find gain, trying to add gain to filter dict
+            try:
+                fitsFiles[frame.type][frame.filter] = {}
+                fitsFiles[frame.type][frame.filter][frame.gain] = {}
+                fitsFiles[frame.type][frame.filter][frame.gain][frame.intTime] = FrameList(frame)
+            except KeyError as e: #Couldn't find intTime, trying to add intTime to type dict
+                try: 
+                    fitsFiles[frame.type] = {}
+                    fitsFiles[frame.type][frame.filter] = {}
+                    fitsFiles[frame.type][frame.filter][frame.gain] = {}
+                    fitsFiles[frame.type][frame.filter][frame.gain][frame.intTime] = FrameList(frame)
+                except KeyError as e: #Couldn't find type dict, trying to add type dict
+                    params.logger.exception(e)
+
 def findFITS(params):
     fitsFiles = dict()
     params.logger.debug("Got to: findFITS function")
     
     #Assume all raw light and all calibration frames are in some directory (indir)
-    fitsFileList = glob.glob(f"{params.datadir}/**/*.fits", recursive=True) + glob.glob(f"{params.caldir}/**/*.fits", recursive=True)
+    #  Frames may be fpack-compressed (.fits.fz), they are read without decompressing to disk
+    #  Sorted so the frames end up in the same order on every run
+    fitsFileList = []
+    for directory in (params.datadir, params.caldir):
+        fitsFileList += sorted(f for pattern in ("*.fits", "*.fits.fz") \
+                               for f in glob.glob(f"{directory}/**/{pattern}", recursive=True))
     params.logger.info(f"Found {len(fitsFileList)} FITS files.")
 
+    #The same file is found twice if caldir is inside datadir
+    fitsFileList = list(dict.fromkeys(os.path.realpath(f) for f in fitsFileList))
+    params.logger.info(f"{len(fitsFileList)} FITS files after removing repeated paths.")
+
+    #Records of files scanned by earlier runs
+    catalog = None if params.no_catalog else FITSCatalog(params.catalog or f"{params.outdir}/catalog.sqlite")
+    records = catalog.records() if catalog else {}
+
     #Go through each fits file and create a Frame object for each \
     #   and construct FrameList objects
-    for fitsFile in tqdm.tqdm(fitsFileList, desc="Finding FITS"):
-        with astropy.io.fits.open(fitsFile) as hdul:
-            hdu = hdul[0]
-            #Carve-out for bias and dark frames for which header does not report filter
-            try:
-                #Check to see if this filter was specified to be skipped
-                if hdu.header['FILTER'].upper().strip() in params.excludeFilter[0]:
-                    continue
-                if hdu.header['FRAMETYP'].lower().strip() == "flat" and params.no_flat:
-                    continue
-                if hdu.header['FRAMETYP'].lower().strip() == 'badpx':
-                    continue
-
-                frame = Frame(hdu.data, hdu.header['FRAMETYP'].lower(), hdu.header['FILTER'].upper(), \
-                            hdu.header['GAIN'], hdu.header['EXPTIME'], hdu.header
-                            )
-                                            
-            except Exception as e: #We expect bias and dark frames to fail to resolve the 'FILTER' key in the header
-                frame = Frame(hdu.data, type=hdu.header['FRAMETYP'].lower(), filter=None, \
-                                gain=hdu.header['GAIN'], intTime=hdu.header['EXPTIME'], header=hdu.header
-                                )
-            #Create all of the dictionaries!
-            try:
-                #If frameList for filter is alr defined ...
-                fitsFiles[frame.type][frame.filter][frame.gain][frame.intTime].append(frame)
-                #print(f"Added frame {str(frame)} to dictionary!")
-            except KeyError as e: #Couldn't find FrameList for that intTime, trying to add new FrameList for intTime
-                try:
-                    fitsFiles[frame.type][frame.filter][frame.gain][frame.intTime] = FrameList(frame)
-                except KeyError as e: #Couldn't find gain, trying to add gain to filter dict
-                    try:
-                        fitsFiles[frame.type][frame.filter] = {}
-                        fitsFiles[frame.type][frame.filter][frame.gain] = {}
-                        fitsFiles[frame.type][frame.filter][frame.gain][frame.intTime] = FrameList(frame)
-                    except KeyError as e: #Couldn't find intTime, trying to add intTime to type dict
-                        try: 
-                            fitsFiles[frame.type] = {}
-                            fitsFiles[frame.type][frame.filter] = {}
-                            fitsFiles[frame.type][frame.filter][frame.gain] = {}
-                            fitsFiles[frame.type][frame.filter][frame.gain][frame.intTime] = FrameList(frame)
-                        except KeyError as e: #Couldn't find type dict, trying to add type dict
-                            params.logger.exception(e)
+    #  Files are opened by a pool of threads (reading is I/O bound), but map()
+    #  hands the frames back in file order so the dictionary is built deterministically
+    params.logger.debug(f"Reading FITS files with {params.workers} threads")
+    changed, seen = {}, {}
+    with ThreadPoolExecutor(max_workers=params.workers) as pool:
+        results = pool.map(lambda fitsFile: readFITS(params, fitsFile, records.get(fitsFile)), fitsFileList)
+        for frame, record in tqdm.tqdm(results, total=len(fitsFileList), desc="Finding FITS"):
+            if record is not records.get(record['path']):
+                changed[record['path']] = record
+
+            #Copies of a frame are only counted once
+            #  Only files with the same size and header values are compared (see sameContents)
+            candidates = seen.setdefault(FITSCatalog.duplicateKey(record), [])
+            copy = None
+            for candidate in candidates:
+                unhashed = [r for r in (candidate, record) if r['hash'] is None]
+                if FITSCatalog.sameContents(candidate, record):
+                    copy = candidate
+                #Hashes computed on the way are stored in the catalog
+                changed.update((r['path'], r) for r in unhashed if r['hash'] is not None)
+                if copy is not None:
+                    break
+            if copy is not None:
+                params.logger.info(f"Skipping {record['path']}, same contents as {copy['path']}")
+                continue
+            candidates.append(record)
+
+            if frame is None:
+                continue
+            addFrame(params, fitsFiles, frame)
+
+    if catalog:
+        params.logger.info(f"Cataloged {len(changed)} new or changed FITS files.")
+        catalog.update(changed.values())
+        catalog.close()
     return fitsFiles
 
 def getDarks(params, frameList):
@@ -209,6 +398,93 @@ def getDarks(params, frameList):
             exit()
         return darks
 
+def combineOptions(params):
+    """Return keyword arguments for accumulate set by the program arguments"""
+    return dict(memory=params.memory*1024**2, scratch=params.scratchdir, workers=params.processes, \
+                combine=params.combine, dtype=np.dtype(params.precision))
+
+def taskSettings(params):
+    """Return the program arguments used by the pipeline tasks as a plain (picklable) dictionary
+    Worker processes do not share params, so tasks get their settings from this instead
+    """
+    return dict(options=combineOptions(params), library=getattr(params, "library", None), \
+                combine=params.combine, precision=params.precision, length=params.length, \
+                radius=params.radius, fwhm=params.fwhm, excludeBad=params.stats_exclude_bad, \
+                tile=params.detect_tile, detectWorkers=params.detect_processes)
+
+def _libraryAccumulate(settings, sources, build, listType):
+    #Look up a master in the library before building it with build()
+    #  sources are all raw frames contributing to the master (e.g. flats AND their darks)
+    library = settings['library']
+    if library is None:
+        return build()
+
+    #Only settings that change the result are part of the key
+    key = library.makeKey(sources, listType, combine=settings['combine'], precision=settings['precision'])
+    cached = library.get(key)
+    if cached is not None:
+        if library.logger:
+            library.logger.info(f"\t\t\tUsing {listType} master from library ({key[:12]})")
+        return cached
+
+    data, badMap = build()
+    library.put(key, data, badMap)
+    return data, badMap
+
+def taskFrames(frames):
+    """Return FrameList of deferred copies of frames, handles that read their pixels from file
+    Frames in memory would otherwise be pickled with all their pixels when sent to a worker
+    """
+    handles = None
+    for f in frames:
+        handle = Frame(None, f.type, f.filter, f.gain, f.intTime, f.record, path=f.path)
+        if handles is None:
+            handles = FrameList(handle)
+        else:
+            handles.append(handle)
+    return handles
+
+def masterDarkTask(darks, settings):
+    """Return (master dark, good pixel map) combined from a FrameList of darks
+    settings are the taskSettings; like all tasks it can run in a worker process
+    """
+    return _libraryAccumulate(settings, darks, lambda: accumulate(darks, "dark", **settings['options']), "dark")
+
+def masterFlatTask(flats, darks, masterDark, settings):
+    """Return (normalized master flat, good pixel map) combined from a FrameList of flats
+    masterDark is the (master dark, map) of darks, as returned by masterDarkTask
+    (darks are only needed to look the flat up in the library)
+    """
+    def build():
+        #Flats are dark-subtracted one at a time as the combine step reads them
+        darkSubtracted = CalibratedFrames(flats, masterDark[0], dtype=settings['precision'])
+        masterFlat, masterFlatMap = accumulate( darkSubtracted, "flat", **settings['options'] )
+        flat_C = np.median(masterFlat)
+
+        #Normalize flat frame
+        masterFlat /= flat_C
+        return masterFlat, masterFlatMap
+
+    return _libraryAccumulate(settings, list(flats) + list(darks), build, "flat")
+
+def masterLightTask(lights, masterDark, masterDarkForFlat, masterFlat, settings):
+    """Return (master light, good pixel map) combined from a FrameList of lights
+    masterDark, masterDarkForFlat and masterFlat are (master, map) task results.
+    The map is only True for pixels that are good in the light, both darks and the flat.
+    """
+    #Each light is calibrated, (l-dark)/flat in place, as the combine step reads it
+    calibratedLights = CalibratedFrames(lights, masterDark[0], masterFlat[0], dtype=settings['precision'])
+    masterLight, masterLightMap = accumulate( calibratedLights, "light", **settings['options'] )
+
+    #Maps are True for good pixels, a pixel is only good if it is good in every map
+    masterBadPixelMap = np.logical_and.reduce([masterLightMap, masterDark[1], masterDarkForFlat[1], masterFlat[1]])
+    return masterLight, masterBadPixelMap
+
+def extractTask(masterLight, intTime, settings):
+    """Return extractSources result for the (master light, map) of masterLightTask"""
+    return extractSources(masterLight[0], masterLight[1], intTime, settings['length'], settings['radius'], \
+                          settings['fwhm'], settings['excludeBad'], settings['tile'], settings['detectWorkers'])
+
 def fitGaussian1D(radialData, p0, pixelLocs):
     # p0 behaves by taking a best guess at params (mu, sigma, amplitude, offset)
     params, _ = curve_fit(gaussian1D, pixelLocs, radialData, p0)
@@ -225,47 +501,262 @@ def gaussian1D(x, mu, sigma, amplitude, offset):
     #Model function as gaussian with amplitude A and offset G
     return amplitude * np.exp( -((x-mu)/sigma)**2/2 ) + offset
 
-def extractRadialData(subFrame, xC, yC):
-    #Get matrix of integer indices associated with subFrame
-    y, x = np.indices((subFrame.shape))
-
-    #Generate matrix of radius values
-    r = np.sqrt((x - xC)**2 + (y - yC)**2)
-
-    #Force integer values (np.sqrt gives floats)
-    r = r.astype(int)
-
-    #Generate a histogram of radius bin, each weighed by corresponding counts
-    weightedRadiusHistogram = np.bincount(r.ravel(), weights=subFrame.ravel())
-    unweightedRadiusHistogram = np.bincount(r.ravel())
+def gaussianGuess(radialData, pixelLocs):
+    """Return (profiles, 4) array of moment-based initial guesses (mu, sigma, amplitude, offset)
+    for each row of radialData (profiles, len(pixelLocs)); missing (NaN) values are ignored
+    offset is the median of the outermost values, mu the centroid of the values above half
+    maximum, and sigma follows from the area above the offset.
+    """
+    x = np.asarray(pixelLocs, dtype=np.float64)
+    edge = max(2, len(x) // 10)
+    offset = np.nanmedian(np.concatenate((radialData[:, :edge], radialData[:, -edge:]), axis=1), axis=1)
+    above = np.nan_to_num(radialData - offset[:, np.newaxis])
+    amplitude = np.maximum(above.max(axis=1), np.finfo(np.float64).tiny)
+
+    top = np.where(above > amplitude[:, np.newaxis] / 2, above, 0)
+    mu = top @ x / np.maximum(top.sum(axis=1), np.finfo(np.float64).tiny)
+    #Area of a gaussian is amplitude*sigma*sqrt(2 pi)
+    area = np.clip(above, 0, None).sum(axis=1) * (x[-1] - x[0]) / max(len(x) - 1, 1)
+    sigma = area / (amplitude * np.sqrt(2*np.pi))
+    return np.column_stack((mu, np.maximum(sigma, 0.5), amplitude, offset))
+
+def fitGaussian1DBatch(radialData, pixelLocs, p0=None, maxIter=100, tolerance=1e-10):
+    """Fit gaussian1D to every row of radialData (profiles, len(pixelLocs)) at once
+    Returns ((profiles, 4) array of (mu, sigma, amplitude, offset), R2 of every profile).
+    All profiles take Levenberg-Marquardt steps together, with the analytic Jacobian of
+    gaussian1D and p0 (default: gaussianGuess) as starting point. Profiles that do not
+    converge within maxIter steps are fitted again with fitGaussian1D (NaN if that fails too).
+    Missing (NaN) profile values are left out of the fit.
+    """
+    y = np.asarray(radialData, dtype=np.float64)
+    x = np.asarray(pixelLocs, dtype=np.float64)
+    weights = np.isfinite(y)
+    y = np.where(weights, y, 0)
+    p = gaussianGuess(radialData, pixelLocs) if p0 is None else np.array(p0, dtype=np.float64)
+
+    def residualsAndJacobian(p):
+        mu, sigma, amplitude, offset = (p[:, i, np.newaxis] for i in range(4))
+        z = (x - mu) / sigma
+        e = np.exp(-z*z/2)
+        residuals = (y - amplitude*e - offset) * weights
+        #d model / d (mu, sigma, amplitude, offset)
+        jacobian = np.stack((amplitude*e*z/sigma, amplitude*e*z*z/sigma, e, np.ones_like(e)), axis=-1)
+        return residuals, jacobian * weights[..., np.newaxis]
+
+    residuals, jacobian = residualsAndJacobian(p)
+    cost = np.sum(residuals**2, axis=1)
+    damping = np.full(len(p), 1e-3)
+    converged = np.zeros(len(p), dtype=bool)
+    for _ in range(maxIter):
+        active = ~converged
+        if not active.any():
+            break
+        JTJ = np.einsum('nmi,nmj->nij', jacobian[active], jacobian[active])
+        JTr = np.einsum('nmi,nm->ni', jacobian[active], residuals[active])
+        #Marquardt scaling by the diagonal, floored so flat directions stay solvable
+        diagonal = np.einsum('nii->ni', JTJ)
+        diagonal = np.maximum(diagonal, 1e-12 * diagonal.max(axis=1, keepdims=True) + 1e-300)
+        step = np.linalg.solve(JTJ + (damping[active, np.newaxis] * diagonal)[..., np.newaxis] * np.eye(4), \
+                               JTr[..., np.newaxis])[..., 0]
+
+        trialP = p.copy()
+        trialP[active] += step
+        trialResiduals, trialJacobian = residualsAndJacobian(trialP)
+        trialCost = np.sum(trialResiduals**2, axis=1)
+
+        #Accept steps that lower the cost and trust the linearization more, else damp harder
+        better = active & np.isfinite(trialCost) & (trialCost < cost)
+        worse = active & ~better
+        change = np.where(better, cost - trialCost, 0)
+        p[better] = trialP[better]
+        residuals[better], jacobian[better] = trialResiduals[better], trialJacobian[better]
+        converged |= better & (change <= tolerance * np.maximum(cost, 1e-300))
+        cost[better] = trialCost[better]
+        damping[better] /= 10
+        damping[worse] *= 10
+        #A step that can no longer lower the cost means the minimum is found
+        converged |= worse & (damping > 1e10)
+
+    #Profiles the batch did not settle are fitted one by one
+    for i in np.flatnonzero(~converged):
+        try:
+            p[i], _ = fitGaussian1D(radialData[i][weights[i]], p[i], x[weights[i]])
+        except (RuntimeError, ValueError, TypeError):
+            p[i] = np.nan
+    p[:, 1] = np.abs(p[:, 1])
+
+    #Coefficient of determination of every profile
+    model = gaussian1D(x, *(p[:, i, np.newaxis] for i in range(4)))
+    sumSqrs_res = np.sum(np.where(weights, y - model, 0)**2, axis=1)
+    mean = np.sum(y, axis=1, keepdims=True) / np.maximum(weights.sum(axis=1, keepdims=True), 1)
+    totSumSqrs = np.sum(np.where(weights, y - mean, 0)**2, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R2 = 1.0 - (sumSqrs_res / totSumSqrs)
+    return p, R2
 
-    #Get average for each radius bin
-    averageCountsPerRadiusBin = weightedRadiusHistogram / unweightedRadiusHistogram
-    return averageCountsPerRadiusBin
+def extractRadialData(subFrame, xC, yC):
+    #Average counts in each integer radius bin around (xC, yC)
+    #  The radius bin of every pixel is cached per subFrame shape and center
+    return redux_photometry.radialProfiles(subFrame[np.newaxis], xC, yC)[0]
+
+def extractSources(data, badMap, intTime, length, radius, fwhm=None, excludeBad=False, tile=None, detectWorkers=1):
+    """Detect and measure every source of a master light
+    Only takes and returns plain values (np.ndarrays, numbers, dictionaries), so it can run
+    in a worker process. Returns a dictionary with the FWHM used for detection, the frame
+    statistics and, for every source, its id, position (rows, cols), cutout, radial profile,
+    Gaussian fit and aperture photometry (see redux_photometry.aperturePhotometry).
+    Frames larger than tile pixels are searched in tiles by detectWorkers processes.
+    """
+    frame = Frame(data, type='master', filter=None, gain=None, intTime=intTime, header=None, badMap=badMap)
+    stats = frame.computeStats(excludeBad=excludeBad)
+
+    #The detection kernel is set by the seeing, estimated once from the frame unless fwhm is given
+    sourceList, fwhm = redux_photometry.detectSources(data, threshold=stats['median'], \
+                            sky=stats['mean'], peakmax=stats['max'], fwhm=fwhm, tile=tile, workers=detectWorkers)
+    result = dict(fwhm=fwhm, stats=stats, shape=data.shape)
+    if sourceList is None:
+        return result
+
+    #Cutouts of every source (rows: ycentroid, columns: xcentroid), padded at the frame border
+    rows, cols = np.asarray(sourceList['ycentroid']), np.asarray(sourceList['xcentroid'])
+    subFrames = redux_photometry.cutouts(data, rows, cols, length)
+    subFramePixelMaps = redux_photometry.cutouts(badMap, rows, cols, length, fill=False)
+
+    #Radial profiles of all sources, mirrored to span the cutout
+    radial_data_raw = redux_photometry.radialProfiles(subFrames, length, length, nBins=length)
+    radialProfiles = np.concatenate((radial_data_raw[:, ::-1], radial_data_raw), axis=1)
+
+    #Gaussian fits of all profiles at once, background from the fit offset
+    pixelLocs = np.linspace(0, length*2, length*2).astype(int)
+    fitParams, fitR2 = fitGaussian1DBatch(radialProfiles, pixelLocs)
+    backgrounds = fitParams[:, -1]
+
+    #Aperture sums of all sources at once
+    photometry = redux_photometry.aperturePhotometry(subFrames, subFramePixelMaps, backgrounds, radius, intTime)
+
+    result.update(ids=np.asarray(sourceList['id']), rows=rows, cols=cols, subFrames=subFrames, \
+                  radialProfiles=radialProfiles, pixelLocs=pixelLocs, fitParams=fitParams, fitR2=fitR2, \
+                  backgrounds=backgrounds, **photometry)
+    return result
+
+def groupName(frame):
+    """Return the name of the (filter, gain, intTime) group of frame used in output file names"""
+    return f"{frame.filter}_{int(frame.gain):d}_{frame.intTime:0.1f}".replace('.','-')
+
+def masterPath(params, kind, frames):
+    """Return file the master of kind (dark|flat|light) combined from frames is written to"""
+    return f"{params.outdir}/master_{params.save}_{kind}_{groupName(frames[0])}.fits"
+
+def reportSources(params, frame, result, renderer=None):
+    """Log the sources extractSources found in master light frame and queue their plots on renderer"""
+    params.logger.info(f"\tSources in {frame}, detected with FWHM {result['fwhm']:0.2f} px")
+    if 'ids' not in result:
+        params.logger.warning(f"\t\tNo sources found")
+        return
+    params.logger.debug(f"Counts no pixelmap minus counts with pixel map:\t{result['countsNoFilter']-result['counts']}")
+
+    for i, sourceID in enumerate(result['ids']):
+        params.logger.info(f"\t\tSource {sourceID}: x={result['cols'][i]:0.2f} y={result['rows'][i]:0.2f} "+\
+                           f"counts={result['counts'][i]:0.1f} nPix={result['nPix'][i]} "+\
+                           f"m_inst={result['instMag'][i]:0.3f} R2={result['fitR2'][i]:0.4f}")
+    if renderer is None:
+        return
+
+    #Every (filter, gain, intTime) group gets its own plots
+    group = groupName(frame)
+    pixelLocs = result['pixelLocs']
+    for i, sourceID in enumerate(result['ids']):
+        fitparams = result['fitParams'][i]
+        renderer.render(redux_plots.plotSource, f"{params.outdir}/subframe_{params.save}_{sourceID}_{group}.png", \
+                        result['subFrames'][i], result['backgrounds'][i], pixelLocs, result['radialProfiles'][i], \
+                        gaussian1D(pixelLocs, *fitparams[:-1], 0), fitparams[0], result['fitR2'][i], \
+                        result['instMag'][i], params.length, params.radius, frame.filter, sourceID)
+
+    stats = result['stats']
+    renderer.render(redux_plots.plotFinder, f"{params.outdir}/finder_{params.save}_{frame.type}_{group}.png", \
+                    redux_plots.downsample(frame.data-stats['mean']), result['shape'], result['rows'], result['cols'], \
+                    result['ids'], result['instMag'], stats['mean']-2*stats['std'], stats['mean']+2*stats['std'])
 
 
 #returns a tuple, (data, badpixelmap)
-def accumulate(frameList,listType=None):
-    #Number of Standard Deviations from the Mean that are "good" pixels
+def accumulate(frameList,listType=None,memory=None,scratch=None,workers=1,combine="median",dtype=np.float64):
+    #combine is the name of the engine in redux_combine.engines used to combine the frames
+    #dtype is the floating point type the combined frame is computed and returned in
+    #memory is the number of bytes the stack may take up while combining (None: no limit)
+    #workers is the number of processes that combine strips of the stack in parallel
+    #frameList may be a list of Frames/np.ndarrays, a StackCube or a CalibratedFrames stage.
+    #  Streaming engines read one (calibrated) frame at a time, the median calibrates one
+    #  strip of rows at a time. Only parallel workers need a CalibratedFrames stage calibrated
+    #  into a (shared) StackCube, and if a scratch directory is given, raw frames are first
+    #  copied into a memory-mapped StackCube there
+    #  Stacks of raw 16-bit frames are median-combined with integer arithmetic only
+    #The median commutes with subtracting the same frame from every frame, so raw
+    #  frames that are only dark-subtracted (flats) are median-combined as integers
+    #  and the master dark is subtracted from the result instead
+    offset = None
+    if combine == "median" and isinstance(frameList, CalibratedFrames) and frameList.masterFlat is None \
+            and frameList.masterDark is not None and redux_combine.isRawInteger(frameList.frames):
+        offset, frameList = frameList.masterDark, frameList.frames
+
+    stack = None
+    if combine not in redux_combine.streamingEngines:
+        if isinstance(frameList, CalibratedFrames):
+            if workers > 1:
+                stack = frameList.toStack(scratch, shared=True)
+        elif scratch is not None and not isinstance(frameList, StackCube):
+            stack = StackCube.fromFrames(frameList, scratch)
+    if stack is not None:
+        frameList = stack
+
+    #Number of (robust) Standard Deviations from the typical pixel that are "good" pixels
     numStd = 3
 
-    goodMask = None
+    #Pixel-wise combination (median: in row strips that fit in memory)
+    #  The pixel-wise scatter through the stack comes out of the same pass
+    combined, scatter = redux_combine.engines[combine]( frameList, memory, workers, dtype )
+    if offset is not None:
+        combined -= offset
 
-    #Darks and Flats have good pixel masks for each frame
-    if listType == "dark":
-        #Generate an all-true pixel mask to start with
-        #  This would mean a pixel mask where all pixels are labelled as "good"
-        goodMask = np.full(frameList[0].data.shape, True)
+    #Good pixel mask (True = good) with the same meaning for darks, flats and lights
+    goodMask = redux_combine.goodPixelMask( combined, scatter, listType, numStd )
 
+    #Frames read from disk on demand do not need to stay in memory
+    if stack is not None:
+        stack.close()
+    elif not isinstance(frameList, CalibratedFrames):
         for f in frameList:
-            pixAvg = np.average(f.data)
-            sigma  = np.std(f.data)
-            frameMin, frameMax = pixAvg - (numStd*sigma), pixAvg + (numStd*sigma)
-            goodMask &= ~np.logical_or(f.data < frameMin, f.data > frameMax )   
+            if isinstance(f, Frame):
+                f.release()
 
-        goodMask = goodMask.astype(bool)    
-    
-    return  (np.median( [f.data for f in frameList], axis=0 ), goodMask)
+    return  (combined, goodMask)
+
+def checkPrecision(params, lights, flats, darksForFlats, darksForLight, masterLight, tolerance=1e-3):
+    """Combine the master light again in float64 from the raw frames and log how far
+    masterLight (computed with --precision) is from it, in units of the standard
+    deviation of the float64 master. Returns that relative difference.
+    """
+    options = dict(combineOptions(params), dtype=np.float64)
+    def master(data, frames):
+        return Frame(data, type='master', filter=frames[0].filter, gain=frames[0].gain, \
+                     intTime=frames[0].intTime, header=frames[0].header)
+
+    darkForFlats, _ = accumulate(darksForFlats, "dark", **options)
+    flat, _ = accumulate(CalibratedFrames(flats, master(darkForFlats, darksForFlats), dtype=np.float64), "flat", **options)
+    flat /= np.median(flat)
+    darkForLight, _ = accumulate(darksForLight, "dark", **options)
+    reference, _ = accumulate(CalibratedFrames(lights, master(darkForLight, darksForLight), master(flat, flats), \
+                                               dtype=np.float64), "light", **options)
+
+    finite = np.isfinite(reference) & np.isfinite(masterLight)
+    difference = np.max(np.abs(masterLight[finite] - reference[finite]))
+    relative = difference / np.std(reference[finite])
+    message = f"\t\t\t{params.precision} master light differs from float64 by at most " \
+              f"{difference:.3g} ({relative:.3g} std, tolerance {tolerance:g} std)"
+    if relative > tolerance:
+        params.logger.warning(message)
+    else:
+        params.logger.info(message)
+    return relative
 
 if __name__ == "__main__":
     from astropy.io import fits
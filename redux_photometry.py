@@ -0,0 +1,286 @@
+##########################################
+#####  Imports
+##########################################
+
+# Native Imports
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import warnings
+
+# Installed Imports
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import maximum_filter
+from astropy.table import vstack
+from photutils.detection import DAOStarFinder
+from photutils.utils.exceptions import NoDetectionsWarning
+
+"""
+Photometry of all sources of a master light at once.
+
+Instead of slicing a subframe per source, every cutout is gathered into one
+(sources, 2*length, 2*length) array, and the aperture and good pixel masks
+are applied to all of them in a single vectorized pass. Radial profiles of
+all cutouts are one matrix product with a cached radius-bin matrix.
+Sources are detected in a single DAOStarFinder pass, with the kernel set
+by a FWHM estimated from the brightest peaks of the frame. Large frames can
+be split into overlapping tiles that are searched in parallel and merged.
+"""
+
+def cutouts(data, rows, cols, length, fill=np.nan):
+    """Return (len(rows), 2*length, 2*length) array of the cutouts
+    data[row-length:row+length, col-length:col+length] around every (row, col)
+    Cutouts of sources near the border are padded with fill.
+    data may also be a Frame, e.g. a raw frame read lazily from a compressed
+    file: only the cutouts are read from it (see Frame.section).
+    """
+    size = 2 * length
+    #Same pixels as slicing data[int(row-length):int(row+length)] for sources inside the frame
+    starts = np.floor(np.column_stack((rows, cols)) - length).astype(int).reshape(-1, 2)
+    if not isinstance(data, np.ndarray):
+        return _frameCutouts(data, starts, size, fill)
+    nRows, nCols = data.shape
+    out = np.full((len(starts), size, size), fill, dtype=np.result_type(data.dtype, np.min_scalar_type(fill)))
+
+    #Cutouts that lie inside the frame are taken from a (zero-copy) view of every
+    #  size x size window of data in one gather
+    inside = np.all((starts >= 0) & (starts <= (nRows - size, nCols - size)), axis=1)
+    if nRows >= size and nCols >= size and inside.any():
+        windows = sliding_window_view(data, (size, size))
+        out[inside] = windows[starts[inside, 0], starts[inside, 1]]
+
+    #The others only copy the part that overlaps the frame
+    for i in np.flatnonzero(~inside):
+        row, col = starts[i]
+        top, left = max(row, 0), max(col, 0)
+        bottom, right = min(row + size, nRows), min(col + size, nCols)
+        if top < bottom and left < right:
+            out[i, top-row:bottom-row, left-col:right-col] = data[top:bottom, left:right]
+    return out
+
+def _frameCutouts(frame, starts, size, fill):
+    #Cutouts read one at a time with Frame.section, so a deferred Frame of a
+    #  compressed (.fits.fz) file only decompresses the tiles they overlap
+    nRows, nCols = frame.shape
+    pieces = []
+    for row, col in starts:
+        top, left = max(row, 0), max(col, 0)
+        bottom, right = min(row + size, nRows), min(col + size, nCols)
+        if top < bottom and left < right:
+            pieces.append((top-row, left-col, frame.section(slice(top, bottom), slice(left, right))))
+        else:
+            pieces.append(None)
+
+    dtypes = [p[2].dtype for p in pieces if p is not None]
+    out = np.full((len(starts), size, size), fill, dtype=np.result_type(*dtypes, np.min_scalar_type(fill)))
+    for i, piece in enumerate(pieces):
+        if piece is not None:
+            top, left, values = piece
+            out[i, top:top+values.shape[0], left:left+values.shape[1]] = values
+    return out
+
+def aperture(length, radius):
+    """Return (2*length, 2*length) boolean map of the pixels closer than radius to the cutout center"""
+    Y, X = np.ogrid[:length*2, :length*2]
+    return np.sqrt((X-length)**2 + (Y-length)**2) < radius
+
+def aperturePhotometry(subFrames, goodMaps, background, radius, intTime):
+    """Return dictionary of arrays with an entry for every source:
+    counts - background subtracted counts of the good pixels in the aperture
+    countsNoFilter - the same without leaving out bad pixels
+    nPix - number of good pixels in the aperture
+    instMag - instrument magnitude of the counts per good pixel per second
+    subFrames, goodMaps are cutout cubes (see cutouts; goodMaps True for good pixels),
+        background is the background level of every source.
+    """
+    length = subFrames.shape[1] // 2
+    #Only the square around the aperture is needed
+    box = slice(max(length - int(np.ceil(radius)), 0), length + int(np.ceil(radius)) + 1)
+    inAperture = aperture(length, radius)[box, box]
+    corrected = subFrames[:, box, box] - np.asarray(background, dtype=np.float64).reshape(-1, 1, 1)
+    goodMaps = goodMaps[:, box, box]
+
+    #Padding outside the frame is neither counted nor a good pixel
+    valid = inAperture & np.isfinite(corrected)
+    good = valid & goodMaps
+    countsNoFilter = np.sum(corrected, axis=(1, 2), where=valid)
+    counts = np.sum(corrected, axis=(1, 2), where=good)
+    nPix = np.count_nonzero(good, axis=(1, 2))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        instMag = -2.5*np.log10(counts/nPix/intTime)
+    return dict(counts=counts, countsNoFilter=countsNoFilter, nPix=nPix, instMag=instMag)
+
+@lru_cache(maxsize=16)
+def _radialBins(shape, yBucket, xBucket, subpixel):
+    yC, xC = yBucket / subpixel, xBucket / subpixel
+    y, x = np.indices(shape)
+    #Integer radius of every pixel is its bin
+    r = np.sqrt((x - xC)**2 + (y - yC)**2).astype(int).ravel()
+    bins = np.zeros((r.size, r.max() + 1))
+    bins[np.arange(r.size), r] = 1
+    r.flags.writeable = bins.flags.writeable = False
+    return r, bins
+
+def radialBins(shape, xC, yC, subpixel=10):
+    """Return (radius bin of every pixel, (pixels, bins) matrix that is 1 where a pixel is in a bin)
+    for frames of shape with center (xC, yC). Pixel radii are floored to integer bins.
+    Both are cached for every shape and center, the center rounded to 1/subpixel pixels.
+    """
+    return _radialBins(tuple(shape), int(round(yC * subpixel)), int(round(xC * subpixel)), subpixel)
+
+def radialProfiles(subFrames, xC, yC, nBins=None, subpixel=10):
+    """Return (sources, bins) array with the average counts in every integer radius bin
+    around (xC, yC) of each cutout in subFrames, only the first nBins bins if given.
+    Pixels without a finite value (padding) are left out.
+    """
+    subFrames = np.asarray(subFrames)
+    values = subFrames.reshape(len(subFrames), -1)
+    #The product is done in the floating point type of the cutouts (float32 is several times faster)
+    _, bins = radialBins(subFrames.shape[1:], xC, yC, subpixel)
+    bins = bins[:, :nBins].astype(np.result_type(values.dtype, np.float32))
+
+    if np.isfinite(values).all():
+        sums, counts = values @ bins, bins.sum(axis=0)
+    else:
+        valid = np.isfinite(values)
+        sums, counts = np.where(valid, values, 0) @ bins, valid @ bins
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / counts
+
+def estimateFWHM(data, length=64, nPeaks=20, numStd=10):
+    """Return median FWHM in pixels of the brightest (isolated) peaks of data, None if there are none
+    Peaks are local maxima more than numStd robust standard deviations above the
+    typical pixel. The FWHM of each is where its radial profile (out to length
+    pixels, background taken at the outermost radii) falls to half of its peak.
+    """
+    #Robust level and noise from every 4th row and column
+    sample = data[::4, ::4]
+    level = np.nanmedian(sample)
+    noise = 1.4826 * np.nanmedian(np.abs(sample - level))
+    peaks = (maximum_filter(data, size=5) == data) & (data > level + numStd * noise)
+    rows, cols = np.nonzero(peaks)
+    order = np.argsort(data[rows, cols])[::-1]
+    rows, cols = rows[order], cols[order]
+
+    #Brightest first, peaks closer than length to a brighter one belong to the same star
+    chosen = []
+    for row, col in zip(rows, cols):
+        if all((row-r)**2 + (col-c)**2 >= length**2 for r, c in chosen):
+            chosen.append((row, col))
+            if len(chosen) == nPeaks:
+                break
+    if not chosen:
+        return None
+
+    rows, cols = np.array(chosen).T
+    profiles = radialProfiles(cutouts(data, rows, cols, length), length, length, nBins=length)
+    #Average radius of the pixels in every bin
+    y, x = np.indices((2*length, 2*length))
+    radii = radialProfiles(np.hypot(x - length, y - length)[np.newaxis], length, length, nBins=length)[0]
+
+    background = np.nanmedian(profiles[:, -max(2, length//8):], axis=1)
+    height = (profiles - background[:, np.newaxis]) / (profiles[:, 0] - background)[:, np.newaxis]
+    fwhm = []
+    for h in height:
+        #First bin below half maximum, interpolated between it and the bin before
+        below = np.flatnonzero(h < 0.5)
+        if len(below) and below[0] > 0:
+            i = below[0]
+            fwhm.append(2 * np.interp(0.5, (h[i], h[i-1]), (radii[i], radii[i-1])))
+    return float(np.median(fwhm)) if fwhm else None
+
+def tiles(shape, tile, margin):
+    """Return list of (core, padded) slice pairs covering a frame of shape
+    The cores are tile x tile blocks that partition the frame, every padded
+    slice is its core grown by margin pixels on each side (clipped to the frame).
+    """
+    out = []
+    for y0 in range(0, shape[0], tile):
+        for x0 in range(0, shape[1], tile):
+            core = (slice(y0, min(y0+tile, shape[0])), slice(x0, min(x0+tile, shape[1])))
+            padded = tuple(slice(max(c.start-margin, 0), min(c.stop+margin, n)) for c, n in zip(core, shape))
+            out.append((core, padded))
+    return out
+
+def findStars(starFind, data):
+    """Return table of the sources starFind (a DAOStarFinder) finds in data, None if there are none
+    photutils 1.13 raises ValueError (broadcasting an empty catalog) instead of returning
+    None when every peak above the threshold fails the sharpness/roundness filters,
+    which is common for tiles and frames without stars.
+    """
+    try:
+        return starFind(data)
+    except ValueError:
+        return None
+
+def _detectTile(data, core, offset, starFind):
+    #Sources of one padded tile whose centroid lies in its core, in frame coordinates
+    #  A pixel i spans [i-0.5, i+0.5), so the cores partition the centroids of the frame
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NoDetectionsWarning)
+        sourceList = findStars(starFind, data)
+    if sourceList is None:
+        return None
+    sourceList['xcentroid'] += offset[1]
+    sourceList['ycentroid'] += offset[0]
+    inCore = np.ones(len(sourceList), dtype=bool)
+    for c, axis in zip(core, ('ycentroid', 'xcentroid')):
+        position = np.asarray(sourceList[axis]) + 0.5
+        inCore &= (position >= c.start) & (position < c.stop)
+    return sourceList[inCore] if inCore.any() else None
+
+def detectTiled(data, starFind, tile, brightest=None, workers=1):
+    """Return table of sources found by starFind (a DAOStarFinder without brightest)
+    searching data in tile x tile blocks, None if there are none.
+    Each block is searched with a margin of three kernel radii around it, so the
+    convolution, peak search and centroid of a source in its core only see the
+    same pixels as a search of the whole frame; a source is kept by the block
+    whose core holds its centroid, so sources in the overlaps are not repeated.
+    Sources are sorted by flux (brightest first, ties by position), only the
+    brightest kept if given, and numbered from 1 like DAOStarFinder does.
+    workers > 1 searches the blocks in that many processes.
+    """
+    kernel = starFind.kernel
+    margin = 3 * max(kernel.xradius, kernel.yradius) + 2
+    blocks = [(data[padded], core, (padded[0].start, padded[1].start)) for core, padded in tiles(data.shape, tile, margin)]
+
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(blocks))) as pool:
+            found = list(pool.map(_detectTile, *zip(*blocks), [starFind]*len(blocks)))
+    else:
+        found = [_detectTile(*block, starFind) for block in blocks]
+    found = [f for f in found if f is not None]
+    if not found:
+        return None
+
+    sourceList = vstack(found)
+    order = np.lexsort((np.asarray(sourceList['xcentroid']), np.asarray(sourceList['ycentroid']), \
+                        -np.asarray(sourceList['flux'])))
+    sourceList = sourceList[order[:brightest]]
+    sourceList['id'] = np.arange(1, len(sourceList)+1)
+    return sourceList
+
+def detectSources(data, threshold, sky, peakmax, fwhm=None, brightest=10, tile=None, workers=1):
+    """Return (table of sources found by DAOStarFinder, FWHM in pixels used for its kernel)
+    The FWHM is estimated from the data (estimateFWHM) unless it is given, so the
+    detection only runs once. It is also stored in the table's meta['fwhm'].
+    Frames with a side longer than tile pixels are searched in tiles by workers
+    processes (see detectTiled).
+    """
+    if fwhm is None:
+        fwhm = estimateFWHM(data)
+    if fwhm is None:
+        #No peak to measure, the kernel the pipeline always used
+        fwhm = 20.0
+    if tile and max(data.shape) > tile:
+        starFind = DAOStarFinder(threshold=threshold, fwhm=fwhm, sky=sky, exclude_border=True, \
+                                 peakmax=peakmax)
+        sourceList = detectTiled(data, starFind, tile, brightest=brightest, workers=workers)
+    else:
+        starFind = DAOStarFinder(threshold=threshold, fwhm=fwhm, sky=sky, exclude_border=True, \
+                                 brightest=brightest, peakmax=peakmax)
+        sourceList = findStars(starFind, data)
+    if sourceList is not None:
+        sourceList.meta['fwhm'] = fwhm
+    return sourceList, fwhm
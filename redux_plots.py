@@ -0,0 +1,97 @@
+##########################################
+#####  Imports
+##########################################
+
+# Native Imports
+from concurrent.futures import ProcessPoolExecutor
+
+# Installed Imports
+import numpy as np
+
+"""
+Diagnostic plots of the source extraction, rendered in background processes.
+
+The plot functions only receive plain arrays and numbers, so the pipeline
+hands them to a PlotRenderer and carries on while the PNGs are drawn.
+pyplot is only imported by the processes that render (Agg backend), so
+runs without plots never load it or draw a figure (matplotlib itself is
+still imported by photutils).
+"""
+
+def _pyplot():
+    #Import matplotlib on first use, without a display
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    return plt
+
+def plotSource(path, subFrame, background, pixelLocs, radialData, fitCurve, fitCenter, R2, instMag, \
+               length, radius, filter, sourceID):
+    """Save the cutout of a source and its radial profile to path
+    fitCurve is the fitted Gaussian (without background) at pixelLocs, centered on fitCenter
+    """
+    plt = _pyplot()
+    from matplotlib.patches import Circle
+
+    fig = plt.figure()
+    plt.subplot(1,2,1)
+    plt.imshow(subFrame-background, cmap='gray')
+
+    plt.gca().add_patch(Circle((length, length),radius=radius, fill=False, edgecolor='m', alpha=0.5, zorder=100, lw=2.0, linestyle="--"))
+
+    xLabels = np.concatenate((np.linspace(0,length,5)[::-1], np.linspace(0,length, 5)[1:])).astype(int)
+
+    plt.xticks(np.linspace(0,length*2,len(xLabels)), xLabels, rotation=45)
+    plt.yticks(np.linspace(0,length*2,len(xLabels)), xLabels)
+
+    plt.subplot(1,2,2)
+    plt.plot(pixelLocs, radialData-background, 'b.')
+    plt.plot(pixelLocs, fitCurve, 'r')
+    plt.grid(1)
+
+    plt.axvline(x = fitCenter-radius, color = 'm', linestyle="--")
+    plt.axvline(x = fitCenter+radius, color = 'm', linestyle="--")
+
+    plt.xticks(np.linspace(0, length*2, len(xLabels)), xLabels, rotation=45)
+    plt.suptitle(f"Filter {filter} PhotUtils Source ID {sourceID} w/o Background\nFit $R^2=${R2:0.4f}; $m={instMag:0.3f}$")
+    plt.savefig(path)
+    plt.close(fig)
+
+def downsample(image, maxPixels=1024):
+    """Return image with every n-th row and column so neither side is longer than maxPixels"""
+    step = max(1, -(-max(image.shape) // maxPixels))
+    return image[::step, ::step]
+
+def plotFinder(path, image, shape, rows, cols, sourceIDs, instMags, vmin, vmax):
+    """Save finder chart of image (possibly downsampled from a frame of shape) with every
+    source marked at (rows, cols) frame coordinates and labeled with its instrument magnitude
+    """
+    plt = _pyplot()
+    fig = plt.figure()
+    #extent keeps the axes in frame pixels, whatever the resolution of image
+    plt.imshow(image, cmap='gray_r', origin='upper', vmin=vmin, vmax=vmax, \
+               extent=(-0.5, shape[1]-0.5, shape[0]-0.5, -0.5))
+    for row, col, sourceID, instMag in zip(rows, cols, sourceIDs, instMags):
+        plt.scatter(col, row, facecolors='none', edgecolors='b', s=50)
+        plt.text(col+5, row+5, "{}, $m_{{inst}}=${:0.3f}".format(sourceID, instMag), color='k')
+    plt.savefig(path)
+    plt.close(fig)
+
+class PlotRenderer:
+    """Renders plots (plotSource, plotFinder) in a pool of background processes
+
+    render() returns at once; close() waits for every plot to be saved and
+    returns the exceptions of plots that failed.
+    """
+
+    def __init__(self, processes=1):
+        self._pool = ProcessPoolExecutor(max_workers=processes)
+        self._futures = []
+
+    def render(self, plot, *args):
+        """Queue plot(*args) (a function of this module)"""
+        self._futures.append(self._pool.submit(plot, *args))
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        return [f.exception() for f in self._futures if f.exception() is not None]
@@ -17,7 +17,6 @@ import numpy as np
 import logging
 from matplotlib import pyplot as plt
 from matplotlib.patches import Circle
-from photutils.detection import DAOStarFinder
 from tqdm import tqdm
 
 """
@@ -38,6 +37,7 @@ sys.path.insert(1, "../")
 # Locally authored classes
 #  These are in different files just because
 import redux_functions
+import redux_photometry
 from Frame import Frame
 from FrameList import FrameList
 
@@ -328,89 +328,19 @@ try:
         if params.debug == True:
             print("found NaN in final light frame. aborting.")
         sys.exit()
-    starFind = DAOStarFinder(
+    # The FWHM is estimated once from the frame, so detection only runs a single time
+    sourceList, fwhm = redux_photometry.detectSources(
+        finalLight.data,
         threshold=finalLight.median,
-        fwhm=20.0,
         sky=finalLight.mean,
-        exclude_border=True,
-        brightest=10,
         peakmax=finalLight.max,
     )
-    sourceList = starFind(finalLight.data)
-
-    try:
-        if (sourceList == None) or (len(sourceList) == 0):
-            params.logger.info(
-                f"No sources found matching the DAOStarFinger parameterization. Running for a smaller FWHM Value (10 px)"
-            )
-            starFind = DAOStarFinder(
-                threshold=finalLight.median,
-                fwhm=10.0,
-                sky=finalLight.mean,
-                exclude_border=True,
-                brightest=10,
-                peakmax=finalLight.max,
-            )
-            sourceList = starFind(finalLight.data)
-            if (sourceList == None) or (len(sourceList) == 0):
-                params.logger.info(
-                    f"No sources found matching the DAOStarFinger parameterization. Running for a smaller FWHM Value (5 px)"
-                )
-                starFind = DAOStarFinder(
-                    threshold=finalLight.median,
-                    fwhm=5.0,
-                    sky=finalLight.mean,
-                    exclude_border=True,
-                    brightest=10,
-                    peakmax=finalLight.max,
-                )
-                sourceList = starFind(finalLight.data)
-                if (sourceList == None) or (len(sourceList) == 0):
-                    params.logger.info(
-                        f"No sources found matching the DAOStarFinger parameterization. Running for a larger FWHM Value (25 px)"
-                    )
-                    starFind = DAOStarFinder(
-                        threshold=finalLight.median,
-                        fwhm=25.0,
-                        sky=finalLight.mean,
-                        exclude_border=True,
-                        brightest=10,
-                        peakmax=finalLight.max,
-                    )
-                    sourceList = starFind(finalLight.data)
-                    if (sourceList == None) or (len(sourceList) == 0):
-                        params.logger.info(
-                            f"No sources found matching the DAOStarFinger parameterization. Running for a larger FWHM Value (35 px)"
-                        )
-                        starFind = DAOStarFinder(
-                            threshold=finalLight.median,
-                            fwhm=35.0,
-                            sky=finalLight.mean,
-                            exclude_border=True,
-                            brightest=10,
-                            peakmax=finalLight.max,
-                        )
-                        sourceList = starFind(finalLight.data)
-                        if (sourceList == None) or (len(sourceList) == 0):
-                            params.logger.info(
-                                f"No sources found matching the DAOStarFinger parameterization. Running for a larger FWHM Value (50 px)"
-                            )
-                            starFind = DAOStarFinder(
-                                threshold=finalLight.median,
-                                fwhm=50.0,
-                                sky=finalLight.mean,
-                                exclude_border=True,
-                                brightest=10,
-                                peakmax=finalLight.max,
-                            )
-                            sourceList = starFind(finalLight.data)
-                            if (sourceList == None) or (len(sourceList) == 0):
-                                params.logger.info(
-                                    f"No sources found matching the DAOStarFinger parameterization. YA DONE FUCKED UP"
-                                )
-                                sys.exit()
-    except:
-        pass
+    params.logger.info(f"Detected sources with estimated FWHM {fwhm:0.2f} px")
+    if (sourceList is None) or (len(sourceList) == 0):
+        params.logger.info(
+            f"No sources found matching the DAOStarFinder parameterization (FWHM {fwhm:0.2f} px)"
+        )
+        sys.exit()
 
     Y, X = np.ogrid[: params.length * 2, : params.length * 2]
     dist = np.sqrt((X - params.length) ** 2 + (Y - params.length) ** 2)
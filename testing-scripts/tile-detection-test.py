@@ -0,0 +1,49 @@
+##############################################
+#####  Imports
+##############################################
+
+# Native Imports
+import warnings
+
+# Installed imports
+import numpy as np
+from photutils.detection import DAOStarFinder
+
+### different directory weirdness
+import sys
+
+sys.path.insert(1, "../")
+
+import redux_photometry
+
+"""
+Checks that the tiled source detection (--detect-tile) finds the same sources,
+with the same IDs, as a search of the whole frame. The stars only cover one
+corner of the field, so most tiles are empty (photutils raises on those
+unless redux_photometry.findStars catches it).
+
+    $ cd testing-scripts && python3 tile-detection-test.py
+"""
+
+warnings.simplefilter('ignore')
+rng = np.random.default_rng(2)
+
+#800x600 frame with 15 stars in its top left quarter
+data = rng.normal(100, 5, (600, 800))
+y, x = np.mgrid[:600, :800]
+for row, col, flux in zip(rng.uniform(20, 250, 15), rng.uniform(20, 380, 15), rng.uniform(500, 5000, 15)):
+    data += flux*np.exp(-((y-row)**2 + (x-col)**2)/(2*2.5**2))
+
+full = DAOStarFinder(threshold=30, fwhm=5.9, sky=100, exclude_border=True, brightest=10, peakmax=data.max())(data)
+for workers in (1, 2):
+    tiled, _ = redux_photometry.detectSources(data, 30, 100, data.max(), fwhm=5.9, brightest=10, tile=256, workers=workers)
+    assert len(tiled) == len(full)
+    assert list(tiled['id']) == list(full['id'])
+    assert np.allclose(tiled['xcentroid'], full['xcentroid']) and np.allclose(tiled['ycentroid'], full['ycentroid'])
+
+#A field without stars has no sources, tiled or not
+empty = rng.normal(100, 5, (600, 800))
+for tile in (None, 256):
+    assert redux_photometry.detectSources(empty, 30, 100, empty.max(), fwhm=5.9, tile=tile)[0] is None
+
+print("Tiled detection matches the whole-frame search")